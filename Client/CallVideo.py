@@ -1,27 +1,54 @@
 import cv2
+import math
 import sys
-import pickle
-import struct
 import threading
 import socket
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel
 from PyQt5.uic import loadUi
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from VideoCodec import get_codec, get_decoder
+from VideoPipeline import VideoPipeline
+from VideoTransport import DatagramTransport, RelayTransport, StreamTransport
+
+VIDEO_CODEC = "jpeg"
+VIDEO_QUALITY = 70
+VIDEO_WIDTH = 640
+VIDEO_HEIGHT = 480
+VIDEO_FPS = 30
+# Calls normally go through the chat server's media relay. Without a call id
+# two clients talk directly at VIDEO_ADDRESS over "tcp" or "udp"; over udp
+# late or incomplete frames are dropped instead of holding up the ones behind.
+VIDEO_TRANSPORT = "tcp"
+VIDEO_ADDRESS = ("::1", 1234)
 
 class VideoDisplaySignal(QObject):
-    signal = pyqtSignal(QPixmap, object)
+    # Frames are emitted from the capture and receive threads as QImages;
+    # QPixmaps may only be made on the GUI thread, in the slots.
+    signal = pyqtSignal(QImage, object)
+    remote = pyqtSignal(QImage, int)
+    stream_event = pyqtSignal(str, int, str)
 
 class CallVideo(QMainWindow):
-    def __init__(self, username, friend_name, camera_index, is_server):
+    def __init__(self, username, friend_name, camera_index, is_server, call_id=None, relay_address=None,
+                 join_token=None):
         super().__init__()
         loadUi("ui/CallVideo.ui", self)
         self.username = username
         self.friend_name = friend_name
         self.is_server = is_server
         self.camera_index = camera_index
+        self.call_id = call_id
 
-        if self.is_server:
+        self.display_video_signal = VideoDisplaySignal()
+        self.display_video_signal.signal.connect(self.display_video)
+        self.display_video_signal.remote.connect(self.display_remote_video)
+        self.display_video_signal.stream_event.connect(self.handle_stream_event)
+
+        if self.call_id is not None:
+            self.setWindowTitle(f"Video Call - {self.friend_name}")
+            self.join_relay(relay_address, join_token)
+        elif self.is_server:
             self.setWindowTitle(f"Video Call - {self.friend_name} gọi cho bạn")
             self.start_server()
         else:
@@ -34,42 +61,63 @@ class CallVideo(QMainWindow):
 
         self.lbFriendCam = self.findChild(QLabel, 'lbFriendCam')
         self.lbMyCam = self.findChild(QLabel, 'lbMyCam')
+        self.friend_cam_geometry = self.lbFriendCam.geometry()
+        self.remote_labels = {}
 
         self.camera = cv2.VideoCapture(self.camera_index)
+        self.codec = get_codec(VIDEO_CODEC, quality=VIDEO_QUALITY, width=VIDEO_WIDTH, height=VIDEO_HEIGHT)
+        self.decoders = {}
         self.is_camera_on = True
         self.is_micro_on = True
 
-        self.display_video_signal = VideoDisplaySignal()
-        self.display_video_signal.signal.connect(self.display_video)
-        
         self.receive_thread = threading.Thread(target=self.receive_video)
-        self.send_thread = threading.Thread(target=self.send_video)
+        self.pipeline = VideoPipeline(self.camera, self.codec, self.transport, self.show_preview, VIDEO_FPS)
 
         self.receive_thread.start()
-        self.send_thread.start()
+        self.pipeline.start()
+
+    def join_relay(self, relay_address, join_token):
+        self.client_socket = socket.create_connection(relay_address)
+        self.transport = RelayTransport(self.client_socket, self.call_id, self.username, join_token,
+                                        self.display_video_signal.stream_event.emit)
+        self.transport.connect()
 
     def start_server(self):
+        if VIDEO_TRANSPORT == "udp":
+            self.client_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.client_socket.bind(VIDEO_ADDRESS)
+            self.transport = DatagramTransport(self.client_socket)
+            return
         self.server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.server_socket.bind(("::1", 1234))
+        self.server_socket.bind(VIDEO_ADDRESS)
         self.server_socket.listen(1)
         self.client_socket, _ = self.server_socket.accept()
+        self.transport = StreamTransport(self.client_socket)
 
     def connect_to_server(self):
+        if VIDEO_TRANSPORT == "udp":
+            self.client_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.transport = DatagramTransport(self.client_socket, VIDEO_ADDRESS)
+            self.transport.connect()
+            return
         self.client_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.client_socket.connect(("::1", 1234))
+        self.client_socket.connect(VIDEO_ADDRESS)
+        self.transport = StreamTransport(self.client_socket)
 
     def stop_call(self):
-        self.client_socket.send(f"call_video_response|{self.username}|{self.friend_name}|reject".encode())
-        self.client_socket.close()
+        if self.call_id is None and VIDEO_TRANSPORT == "tcp":
+            self.client_socket.send(f"call_video_response|{self.username}|{self.friend_name}|reject".encode())
+        self.transport.close()
         if hasattr(self, 'server_socket'):
             self.server_socket.close()
+        self.pipeline.stop()
         self.receive_thread.join()
-        self.send_thread.join()
         self.camera.release()
         self.close()
 
     def toggle_camera(self):
         self.is_camera_on = not self.is_camera_on
+        self.pipeline.paused = not self.is_camera_on
 
     def toggle_micro(self):
         self.is_micro_on = not self.is_micro_on
@@ -77,41 +125,24 @@ class CallVideo(QMainWindow):
     def receive_video(self):
         while True:
             try:
-                data = b""
-                while True:
-                    packet = self.client_socket.recv(4096)
-                    if not packet:
-                        break
-                    data += packet
-                    if len(data) >= struct.calcsize(">L"):
-                        msg_size = struct.unpack(">L", data[:struct.calcsize(">L")])[0]
-                        if len(data) >= msg_size + struct.calcsize(">L"):
-                            frame_data = data[struct.calcsize(">L"):msg_size + struct.calcsize(">L")]
-                            data = data[msg_size + struct.calcsize(">L"):]
-                            frame = pickle.loads(frame_data)
-                            pixmap = self.convert_frame_to_pixmap(frame)
-                            self.display_video_signal.signal.emit(pixmap, self.lbFriendCam)
+                received = self.transport.read_frame()
+                if received is None:
+                    break
+                stream_id, codec_id, frame_data = received
+                decoders = self.decoders.setdefault(stream_id, {})
+                frame = get_decoder(codec_id, decoders).decode(frame_data)
+                if frame is None:
+                    continue
+                self.display_video_signal.remote.emit(self.convert_frame_to_image(frame), stream_id)
             except Exception as e:
                 print(f"Error in receive_video: {e}")
                 break
 
-    def send_video(self):
-        while True:
-            try:
-                if self.is_camera_on:
-                    ret, frame = self.camera.read()
-                    if not ret:
-                        break
-                    frame_data = pickle.dumps(frame)
-                    msg = struct.pack(">L", len(frame_data)) + frame_data
-                    self.client_socket.send(msg)
-                    pixmap = self.convert_frame_to_pixmap(frame)
-                    self.display_video_signal.signal.emit(pixmap, self.lbMyCam)
-            except Exception as e:
-                print(f"Error in send_video: {e}")
-                break
+    def show_preview(self, frame):
+        self.display_video_signal.signal.emit(self.convert_frame_to_image(frame), self.lbMyCam)
 
-    def display_video(self, pixmap, frame_label):
+    def display_video(self, image, frame_label):
+        pixmap = QPixmap.fromImage(image)
         if frame_label is self.lbFriendCam:
             self.lbFriendCam.setPixmap(pixmap)
             self.lbFriendCam.setAlignment(Qt.AlignCenter)
@@ -121,12 +152,61 @@ class CallVideo(QMainWindow):
         else:
             print(f"Unknown frame label: {frame_label}")
 
-    def convert_frame_to_pixmap(self, frame):
+    def display_remote_video(self, image, stream_id):
+        pixmap = QPixmap.fromImage(image)
+        label = self.remote_label(stream_id)
+        if len(self.remote_labels) > 1:
+            pixmap = pixmap.scaled(label.size(), Qt.KeepAspectRatio)
+        label.setPixmap(pixmap)
+        label.setAlignment(Qt.AlignCenter)
+
+    def handle_stream_event(self, kind, stream_id, username):
+        print(f"{username} {kind} the call")
+        if kind == "joined":
+            self.remote_label(stream_id).setToolTip(username)
+        elif kind == "left":
+            self.decoders.pop(stream_id, None)
+            label = self.remote_labels.pop(stream_id, None)
+            if label is self.lbFriendCam:
+                label.clear()
+            elif label is not None:
+                label.deleteLater()
+            self.arrange_remote_labels()
+
+    def remote_label(self, stream_id):
+        # The first remote stream uses lbFriendCam; more participants get
+        # extra labels tiled over the same frame.
+        label = self.remote_labels.get(stream_id)
+        if label is None:
+            if self.lbFriendCam in self.remote_labels.values():
+                label = QLabel(self.frFriendCam)
+                label.show()
+            else:
+                label = self.lbFriendCam
+            self.remote_labels[stream_id] = label
+            self.arrange_remote_labels()
+        return label
+
+    def arrange_remote_labels(self):
+        labels = list(self.remote_labels.values())
+        if len(labels) <= 1:
+            for label in labels:
+                label.setGeometry(self.friend_cam_geometry)
+            return
+        columns = math.ceil(math.sqrt(len(labels)))
+        rows = math.ceil(len(labels) / columns)
+        width = self.frFriendCam.width() // columns
+        height = self.frFriendCam.height() // rows
+        for index, label in enumerate(labels):
+            label.setGeometry((index % columns) * width, (index // columns) * height, width, height)
+
+    def convert_frame_to_image(self, frame):
         height, width, channel = frame.shape
         bytes_per_line = 3 * width
         q_image = QImage(frame.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
-        return pixmap
+        # The copy owns its pixels, so the frame buffer can be reused once
+        # the signal is queued.
+        return q_image.copy()
 
 def main(username, friend_name, camera_index, is_server):
     app = QApplication(sys.argv)
@@ -0,0 +1,97 @@
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import Future
+from PyQt5.QtCore import QObject, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import ProtocolError, parse_fields
+
+class ConnectionClosed(Exception):
+    pass
+
+class Connection(QObject):
+    # The only reader of a FramedSocket. Replies carry the request id of the
+    # request they answer and resolve its Future; frames without a pending
+    # request id are pushes and are emitted as message_received. Requests,
+    # replies and pushes are lists of fields.
+    message_received = pyqtSignal(object)
+    disconnected = pyqtSignal()
+    reply_ready = pyqtSignal(object, object)
+
+    def __init__(self, framed_socket, parent=None):
+        super().__init__(parent)
+        self.socket = framed_socket
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        # Emitted from the reader thread, so callbacks run on the GUI thread.
+        self.reply_ready.connect(self.run_callback)
+        self.thread = threading.Thread(target=self.read_loop, name="connection-reader", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, fields):
+        self.socket.send_fields(fields)
+
+    def request(self, fields, callback=None):
+        # Returns a Future for the reply fields. callback(fields), if given, is
+        # called on the GUI thread once the reply arrives.
+        future = Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionClosed("Not connected to the server"))
+                return future
+            request_id = next(self.request_ids) % 0xFFFFFFFF or next(self.request_ids)
+            self.pending[request_id] = future
+        if callback is not None:
+            future.add_done_callback(lambda future: self.reply_ready.emit(callback, future))
+        try:
+            self.socket.send_fields(fields, request_id)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            future.set_exception(e)
+        return future
+
+    def run_callback(self, callback, future):
+        if future.exception() is not None:
+            print(f"Request failed: {str(future.exception())}")
+            return
+        callback(future.result())
+
+    def read_loop(self):
+        while True:
+            try:
+                frame = self.socket.recv_frame()
+                fields = parse_fields(frame.text(), self.socket.version) if frame is not None else None
+            except (OSError, ProtocolError):
+                frame = None
+            if frame is None:
+                break
+            future = None
+            if frame.request_id:
+                with self.lock:
+                    future = self.pending.pop(frame.request_id, None)
+            if future is not None:
+                future.set_result(fields)
+            else:
+                self.message_received.emit(fields)
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionClosed("Connection to the server was lost"))
+        self.disconnected.emit()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.socket.shutdown(2)
+        except OSError:
+            pass
+        self.socket.close()
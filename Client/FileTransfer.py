@@ -0,0 +1,181 @@
+import hashlib
+import os
+import sys
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import CHUNK_SIZE, FRAME_BINARY, FramedSocket, ProtocolError, encode_chunk, parse_fields
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2
+
+class TransferError(Exception):
+    pass
+
+class TransferThread(QThread):
+    progress = pyqtSignal(str, int, int)
+    transfer_finished = pyqtSignal(str)
+    transfer_failed = pyqtSignal(str, str)
+
+    def __init__(self, server_address, session_token, file_name):
+        super().__init__()
+        self.server_address = server_address
+        self.session_token = session_token
+        self.file_name = file_name
+
+    def open_connection(self):
+        # Transfers use their own connection, authenticated with the session
+        # token of the chat window's login.
+        client_socket = FramedSocket.connect(self.server_address)
+        try:
+            client_socket.send_fields(["resume", self.session_token, "transfer"])
+            response = self.recv_reply(client_socket)
+        except Exception:
+            client_socket.close()
+            raise
+        if response[0] != "resume_success":
+            client_socket.close()
+            raise TransferError("Session expired, please log in again")
+        return client_socket
+
+    def recv_reply(self, client_socket):
+        response = client_socket.recv_fields()
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        return response
+
+    def run(self):
+        # Each attempt starts from what the other side already has, so a
+        # dropped connection only costs the part that was in flight.
+        error = None
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                if self.transfer_once():
+                    self.transfer_finished.emit(self.file_name)
+                    return
+            except TransferError as e:
+                self.transfer_failed.emit(self.file_name, str(e))
+                return
+            except (OSError, ValueError, ProtocolError) as e:
+                error = str(e)
+                print(f"Transfer of {self.file_name} interrupted: {error}")
+            time.sleep(RETRY_DELAY)
+        self.transfer_failed.emit(self.file_name, error or "transfer did not complete")
+
+    def transfer_once(self):
+        raise NotImplementedError
+
+class FileUploadThread(TransferThread):
+    def __init__(self, server_address, session_token, sender, receiver, file_path):
+        super().__init__(server_address, session_token, os.path.basename(file_path))
+        self.sender = sender
+        self.receiver = receiver
+        self.file_path = file_path
+        self.file_size = os.path.getsize(file_path)
+        self.upload_id = make_upload_id(sender, receiver, file_path, self.file_size)
+        self.file_hash = None
+
+    def transfer_once(self):
+        if self.file_hash is None:
+            self.file_hash = hash_file(self.file_path)
+        client_socket = self.open_connection()
+        try:
+            client_socket.send_fields(["upload_begin", self.sender, self.receiver, self.file_name, str(self.file_size),
+                                       self.upload_id, self.file_hash])
+            last_offset = None
+            while True:
+                response = self.recv_reply(client_socket)
+                if response[0] in ("upload_done", "upload_exists"):
+                    self.progress.emit(self.file_name, self.file_size, self.file_size)
+                    return True
+                if response[0] == "upload_error":
+                    raise TransferError(response[-1])
+                if response[0] != "upload_offset":
+                    raise ValueError(f"Unexpected response from server: {'|'.join(response)}")
+                offset = int(response[2])
+                if offset == last_offset:
+                    raise ValueError(f"Server is not accepting data after offset {offset}")
+                last_offset = offset
+                self.send_from(client_socket, offset)
+        finally:
+            client_socket.close()
+
+    def send_from(self, client_socket, offset):
+        with open(self.file_path, 'rb') as file:
+            file.seek(offset)
+            self.progress.emit(self.file_name, offset, self.file_size)
+            while offset < self.file_size:
+                data = file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                client_socket.send_binary(encode_chunk(offset, data))
+                offset += len(data)
+                self.progress.emit(self.file_name, offset, self.file_size)
+        client_socket.send_fields(["upload_end", self.upload_id])
+
+class FileDownloadThread(TransferThread):
+    def __init__(self, server_address, session_token, username, sender, file_name, save_path, file_hash=None):
+        super().__init__(server_address, session_token, file_name)
+        self.username = username
+        self.sender = sender
+        self.file_hash = file_hash or ""
+        self.save_path = save_path
+        self.partial_path = save_path + ".part"
+
+    def transfer_once(self):
+        offset = os.path.getsize(self.partial_path) if os.path.exists(self.partial_path) else 0
+        resumed = offset > 0
+        client_socket = self.open_connection()
+        try:
+            client_socket.send_fields(
+                ["download_file", self.username, self.sender, self.file_name, str(offset), "", self.file_hash])
+            response = self.recv_reply(client_socket)
+            if response[0] == "download_error" and offset and "past the end" in response[-1]:
+                # The partial file is longer than the file on the server, so it
+                # is not a prefix of it; start over.
+                os.remove(self.partial_path)
+                raise ValueError(response[-1])
+            if response[0] == "download_error":
+                raise TransferError(response[-1])
+            if response[0] != "download_begin":
+                raise ValueError(f"Unexpected response from server: {'|'.join(response)}")
+            file_size = int(response[4])
+            # Each frame is written out as soon as it arrives.
+            with open(self.partial_path, 'ab') as file:
+                while True:
+                    frame = client_socket.recv_frame()
+                    if frame is None:
+                        raise ConnectionError("Server closed the connection during download")
+                    if frame.frame_type != FRAME_BINARY:
+                        break
+                    file.write(frame.payload)
+                    offset += len(frame.payload)
+                    self.progress.emit(self.file_name, offset, file_size)
+            if parse_fields(frame.text(), client_socket.version)[0] != "download_end":
+                raise ValueError(f"Unexpected response from server: {frame.text()}")
+        finally:
+            client_socket.close()
+        if self.file_hash and hash_file(self.partial_path) != self.file_hash:
+            # A resumed download may have continued a partial file of other
+            # content, so it is tried again from the start; a full download
+            # that does not match will not get better by retrying.
+            os.remove(self.partial_path)
+            if resumed:
+                raise ValueError("Downloaded file does not match its hash, downloading it again")
+            raise TransferError("Downloaded file does not match its hash")
+        os.replace(self.partial_path, self.save_path)
+        return True
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_upload_id(sender, receiver, file_path, file_size):
+    # Stable for the same file and conversation, so retrying resumes it.
+    modified = int(os.path.getmtime(file_path))
+    key = f"{sender}|{receiver}|{os.path.abspath(file_path)}|{file_size}|{modified}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
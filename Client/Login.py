@@ -1,9 +1,12 @@
+import os
 import sys
-import socket
 from PyQt5.QtWidgets import QApplication, QWidget, QMessageBox
 from PyQt5.uic import loadUi
 from Main import MainChat
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import FramedSocket
+
 server_address = ("fe80::76ae:f254:ba11:2395%21", 1234)
 
 class LoginApp(QWidget):
@@ -16,28 +19,38 @@ class LoginApp(QWidget):
         self.btnRegister.clicked.connect(self.register)
         self.btnLoginWidget.clicked.connect(self.show_login_widget)
         self.main_window = None
+        # Login and register share one connection, which is handed to the
+        # main window after a successful login.
+        self.client_socket = None
 
-    def send_message_to_server(self, message):
+    def send_message_to_server(self, fields):
+        # Returns the reply as a list of fields.
         try:
-            client_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            client_socket.connect(server_address)
-            client_socket.send(message.encode('utf-8'))
-            response = client_socket.recv(1024).decode('utf-8')
-            client_socket.close()
+            if self.client_socket is None:
+                self.client_socket = FramedSocket.connect(server_address)
+            self.client_socket.send_fields(fields)
+            response = self.client_socket.recv_fields()
+            if not response:
+                raise ConnectionError("Server closed the connection")
             return response
         except Exception as e:
-            return f"Error connecting to server: {str(e)}"
+            self.close_connection()
+            return [f"Error connecting to server: {str(e)}"]
+
+    def close_connection(self):
+        if self.client_socket is not None:
+            self.client_socket.close()
+            self.client_socket = None
 
     def login(self):
         username = self.txtUserLogin.text()
         password = self.txtPasswordLogin.text()
-        message = f"login|{username}|{password}"
-        response = self.send_message_to_server(message)
-        if response == "login_success":
+        response = self.send_message_to_server(["login", username, password])
+        if response[0] == "login_success":
             QMessageBox.information(self, "Login", "Login successful!")
-            self.open_main_window(username)
+            self.open_main_window(username, response[1])
         else:
-            QMessageBox.warning(self, "Login", f"Login failed. Server response: {response}")
+            QMessageBox.warning(self, "Login", f"Login failed. Server response: {' '.join(response)}")
 
     def register(self):
         name = self.txtName.text()
@@ -48,19 +61,25 @@ class LoginApp(QWidget):
         if password != re_password:
             QMessageBox.warning(self, "Registration", "Passwords do not match.")
             return
-        message = f"register|{name}|{username}|{password}|{phone}"
-        response = self.send_message_to_server(message)
-        if response == "register_success":
+        response = self.send_message_to_server(["register", name, username, password, phone])
+        if response[0] == "register_success":
             self.show_login_widget()
         else:
-            QMessageBox.warning(self, "Registration", response)
+            QMessageBox.warning(self, "Registration", ' '.join(response))
 
-    def open_main_window(self, username):
+    def open_main_window(self, username, session_token):
         if not self.main_window:
-            self.main_window = MainChat(username)
+            self.main_window = MainChat(username, self.client_socket, session_token)
+            self.main_window.logged_out.connect(self.handle_logged_out)
+            self.client_socket = None
         self.main_window.show()
         self.hide()
 
+    def handle_logged_out(self):
+        self.main_window = None
+        self.txtPasswordLogin.clear()
+        self.show()
+
     def show_register_widget(self):
         self.registerWidget.setEnabled(True)
         self.loginWidget.setVisible(False)
@@ -1,88 +1,75 @@
 import os
 import sys
-import socket
-from PyQt5.QtWidgets import QApplication, QMainWindow, QInputDialog, QLabel, QMessageBox, QFileDialog
-from PyQt5.QtCore import Qt, pyqtSignal, QThread, QTimer
-from PyQt5 import QtWidgets, QtCore, QtGui
+import threading
+from PyQt5.QtWidgets import QMainWindow, QInputDialog, QLabel, QMessageBox, QFileDialog
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
+from PyQt5 import QtWidgets, QtCore
 from PyQt5.uic import loadUi
 from CallVideo import CallVideo
+from Connection import Connection
+from FileTransfer import FileDownloadThread, FileUploadThread
+from MessageCache import MessageCache, conversation_id, parse_messages
+from MessageModel import BubbleDelegate, Message, MessageModel
 
-server_address = ("fe80::76ae:f254:ba11:2395%21", 1234)
-
-class MessageThread(QThread):
-    messages_received = pyqtSignal(str)
-
-    def __init__(self, client_socket, sender, receiver):
-        super().__init__()
-        self.client_socket = client_socket
-        self.sender = sender
-        self.receiver = receiver
-        self.running = True
-
-    def run(self):
-        while self.running:
-            self.client_socket.send(f"get_messages|{self.sender}|{self.receiver}".encode())
-            messages_data = self.client_socket.recv(1024).decode()
-            self.messages_received.emit(messages_data)
-            self.msleep(100)
-
-    def stop(self):
-        self.running = False
-
-class VideoCallThread(QThread):
-    video_call_request_signal = pyqtSignal(str)
-
-    def __init__(self, client_socket):
-        super().__init__()
-        self.client_socket = client_socket
-        self.running = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import FramedSocket, ProtocolError
 
-    def run(self):
-        timer = QTimer(self)
-        timer.timeout.connect(self.check_video_call_request)
-        timer.start(1000)
-        self.exec_()
-
-    def check_video_call_request(self):
-        try:
-            data = self.client_socket.recv(1024)
-            if not data:
-                self.stop()
-                return
-
-            message = data.decode('utf-8')
-            if message.startswith("video_call_request"):
-                self.video_call_request_signal.emit(message)
-        except Exception as e:
-            print(f"Error in VideoCallThread: {str(e)}")
-
-    def stop(self):
-        self.running = False
+server_address = ("fe80::76ae:f254:ba11:2395%21", 1234)
+# Messages shown from the local cache when a chat opens, and how many newer
+# ones each sync request asks the server for.
+CACHE_RENDER_LIMIT = 1000
+SYNC_PAGE_SIZE = 500
+# A chat with nothing cached starts from this many of the newest messages;
+# scrolling to the top loads that many older ones at a time.
+OLDER_PAGE_SIZE = 100
+RECONNECT_DELAY = 3000
+# Seconds to wait for the server to answer resume.
+RESUME_TIMEOUT = 10
 
 class MainChat(QMainWindow):
-    update_messages_signal = pyqtSignal(str)
-    def __init__(self, username):
+    update_messages_signal = pyqtSignal(object)
+    reconnect_finished = pyqtSignal(object, str)
+    logged_out = pyqtSignal()
+    def __init__(self, username, framed_socket, session_token):
         super().__init__()
         loadUi("ui/MainChat.ui", self)
         self.username = username
-        self.client_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.client_socket.connect(server_address)
-        self.client_socket.send(username.encode())
+        # framed_socket is the connection Login authenticated; the token lets
+        # us reconnect with resume instead of logging in again.
+        self.session_token = session_token
+        self.connection = None
+        self.logging_out = False
+        self.start_connection(framed_socket)
         self.setWindowTitle(f"Py-Chat - {self.username}")
         self.avtUser.setText(self.username)
         self.txtNameUser.setText(self.username)
         self.btnSend.clicked.connect(self.send_message)
         self.btnAddFriend.clicked.connect(self.add_friend)
+        self.btnSearch.clicked.connect(self.search_users)
         self.btnCallVideo.clicked.connect(self.start_call_video)
         self.btnSendFile.clicked.connect(self.send_file_dialog)
+        self.btnLogOut.clicked.connect(self.logout)
+        self.reconnect_finished.connect(self.handle_reconnected)
         self.listFriends.itemClicked.connect(self.handle_friend_click)
+        self.message_model = MessageModel(self)
+        self.message_delegate = BubbleDelegate(self.listMsg)
+        self.message_delegate.download_requested.connect(self.download_file)
+        self.listMsg.setModel(self.message_model)
+        self.listMsg.setItemDelegate(self.message_delegate)
+        self.listMsg.verticalScrollBar().valueChanged.connect(self.handle_scroll)
         self.load_friends_list()
         self.friend_name = None
+        self.transfer_threads = []
+        self.message_cache = MessageCache(self.username)
+        # Pushed messages go into the cache only once the open chat has caught
+        # up, so the cache never has a gap below its last order. Until then
+        # they wait in pending_pushes.
+        self.synced = False
+        self.pending_pushes = []
+        self.loading_older = False
+        self.video_call = None
         self.txtMsg.setEnabled(False)
-        self.message_thread = MessageThread(self.client_socket, self.username, "")
-        self.message_thread.messages_received.connect(self.handle_messages_received)
         self.update_messages_signal.connect(self.display_messages)
-        self.message_thread.start()
         
     def send_file_dialog(self):
         file_dialog = QFileDialog()
@@ -92,104 +79,278 @@ class MainChat(QMainWindow):
             
     def send_file(self, file_path):
         try:
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-                file_name = os.path.basename(file_path)
-                message = f"send_file|{self.username}|{self.friend_name}|{file_name}|{len(file_data)}"
-                self.client_socket.send(message.encode())
-                response = self.client_socket.recv(1024).decode()
-                print(f"Response from server: {response}")
-                if response == "ready_to_receive":
-                    self.client_socket.send(file_data)
-                    QMessageBox.information(self, "File Sent", f"File '{file_name}' sent successfully!")
-                else:
-                    QMessageBox.warning(self, "Error", f"Failed to send file: {response}")
-        except Exception as e:
+            upload_thread = FileUploadThread(server_address, self.session_token, self.username, self.friend_name, file_path)
+        except OSError as e:
             QMessageBox.warning(self, "Error", f"Error sending file: {str(e)}")
-    def download_file(self, sender, file_name):
+            return
+        upload_thread.transfer_finished.connect(
+            lambda file_name: QMessageBox.information(self, "File Sent", f"File '{file_name}' sent successfully!"))
+        self.start_transfer(upload_thread, "Sending")
+
+    def download_file(self, sender, file_name, file_hash=None):
         save_path, _ = QFileDialog.getSaveFileName(self, "Save File", file_name)
         if save_path:
-            try:
-                # Gửi yêu cầu tải file đến server
-                self.client_socket.send(f"download_file|{self.username}|{sender}|{file_name}".encode())
+            download_thread = FileDownloadThread(server_address, self.session_token, self.username, sender, file_name, save_path, file_hash)
+            download_thread.transfer_finished.connect(
+                lambda file_name: QMessageBox.information(self, "File Downloaded", f"File '{file_name}' downloaded successfully!"))
+            self.start_transfer(download_thread, "Downloading")
+
+    def start_transfer(self, transfer_thread, action):
+        transfer_thread.progress.connect(
+            lambda file_name, done, total: self.show_transfer_progress(action, file_name, done, total))
+        transfer_thread.transfer_finished.connect(lambda file_name: self.statusBar().clearMessage())
+        transfer_thread.transfer_failed.connect(self.handle_transfer_failed)
+        transfer_thread.finished.connect(lambda: self.transfer_threads.remove(transfer_thread))
+        self.transfer_threads.append(transfer_thread)
+        transfer_thread.start()
+
+    def show_transfer_progress(self, action, file_name, done, total):
+        percent = int(done * 100 / total) if total else 100
+        self.statusBar().showMessage(f"{action} '{file_name}': {percent}%")
+
+    def handle_transfer_failed(self, file_name, error):
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, "Error", f"Transfer of '{file_name}' failed: {error}")
 
-                # Nhận dữ liệu file từ server
-                file_data = self.client_socket.recv(1024)
-
-                # Lưu dữ liệu file vào đường dẫn đã chọn
-                with open(save_path, 'wb') as file:
-                    file.write(file_data)
-
-                QMessageBox.information(self, "File Downloaded", f"File '{file_name}' downloaded successfully!")
-            except Exception as e:
-                QMessageBox.warning(self, "Error", f"Error downloading file: {str(e)}")
     def start_call_video(self):
         friend_name = self.txtNameFriend.text()
         print(f"Trying to start a video call with {friend_name}")
-        self.client_socket.send(f"call_video_request|{self.username}|{friend_name}".encode())
-
-    def handle_messages_received(self, messages_data):
-        parts = messages_data.split("|")
-        if parts[0] == "video_call_request":
-            caller, friend_name = parts[1], parts[2]
-            self.handle_video_call_request(caller, friend_name)
+        # While a call is open, calling someone else invites them into it.
+        call_id = self.video_call.call_id if self.video_call is not None and self.video_call.isVisible() else ""
+        self.connection.send(["call_video_request", self.username, friend_name, call_id])
+
+    def handle_messages_received(self, parts):
+        if parts[0] == "history":
+            self.update_messages_signal.emit(parts[1])
+        elif parts[0] == "sync":
+            self.handle_sync(parts[1], parts[2], parts[3])
+        elif parts[0] == "latest":
+            self.handle_latest(parts[1], parts[2], parts[3])
+        elif parts[0] == "new_message":
+            self.handle_new_message(*parts[1:8])
+        elif parts[0] in ("received_message", "file_received"):
+            print(f"New message from {parts[1]}")
+        elif parts[0] == "video_call_request":
+            self.handle_video_call_request(*parts[1:6])
         elif parts[0] == "video_call_response":
-            caller, friend_name, response = parts[1], parts[2], parts[3]
-            self.handle_video_call_response(caller, friend_name, response)
+            self.handle_video_call_response(*parts[1:7])
+        elif parts[0] == "messages_error":
+            self.statusBar().showMessage(f"Could not load the messages with {parts[2]}, try again later")
+        elif parts[0] == "send_message_error":
+            self.statusBar().showMessage(f"Message to {parts[1]} sent at {parts[2]} was not delivered: {parts[3]}")
+        elif parts[0] == "video_call_error":
+            QMessageBox.warning(self, "Video Call", f"Could not add to the call: {parts[2]}")
+        elif isinstance(parts[0], list):
+            # Reply to get_messages: just the list of messages.
+            self.update_messages_signal.emit(parts[0])
+        else:
+            print(f"Unexpected message from server: {parts}")
+
+    def handle_sync(self, owner, friend_name, messages_data):
+        if owner != self.username or friend_name != self.friend_name:
+            # Reply for a chat that is no longer open.
+            return
+        messages = parse_messages(messages_data)
+        if not messages:
+            self.finish_sync()
+            return
+        key = conversation_id(owner, friend_name)
+        first_order, _, complete = self.message_cache.get_range(key)
+        self.message_cache.save(key, messages)
+        self.message_cache.set_range(key, first_order, messages[-1]["order"], complete)
+        for message in messages:
+            self.add_message(message["sender"], message["message"], message["timestamp"], message["message_type"],
+                             message["sender"] != self.username, message["file_hash"], message["order"])
+        self.listMsg.scrollToBottom()
+        self.connection.request(["subscribe", owner, friend_name, str(messages[-1]['order']), str(SYNC_PAGE_SIZE)],
+                                self.handle_messages_received)
+
+    def handle_latest(self, owner, friend_name, messages_data):
+        if owner != self.username or friend_name != self.friend_name:
+            return
+        key = conversation_id(owner, friend_name)
+        messages = parse_messages(messages_data)
+        self.message_cache.save(key, messages)
+        if messages:
+            self.message_cache.set_range(key, messages[0]["order"], messages[-1]["order"],
+                                         len(messages) < OLDER_PAGE_SIZE)
         else:
-            self.update_messages_signal.emit(messages_data)
+            self.message_cache.set_range(key, 0, 0, True)
+        for message in messages:
+            self.add_message(message["sender"], message["message"], message["timestamp"], message["message_type"],
+                             message["sender"] != self.username, message["file_hash"], message["order"])
+        self.listMsg.scrollToBottom()
+        self.finish_sync()
+
+    def finish_sync(self):
+        # The subscription was in place before the server read the history,
+        # so the history and the pushes since then leave no gap.
+        self.synced = True
+        pending, self.pending_pushes = self.pending_pushes, []
+        self.cache_pushed(pending)
+
+    def cache_pushed(self, messages):
+        key = conversation_id(self.username, self.friend_name)
+        cached_range = self.message_cache.get_range(key)
+        if not messages or cached_range is None:
+            return
+        first_order, last_order, complete = cached_range
+        self.message_cache.save(key, messages)
+        self.message_cache.set_range(key, first_order, max([last_order] + [message["order"] for message in messages]),
+                                     complete)
+
+    def handle_scroll(self, value):
+        if self.synced and value == self.listMsg.verticalScrollBar().minimum():
+            self.load_older()
+
+    def load_older(self):
+        # Older messages come from the cache while it has them and then from
+        # the server, one page at a time.
+        if self.loading_older or not self.friend_name:
+            return
+        key = conversation_id(self.username, self.friend_name)
+        cached_range = self.message_cache.get_range(key)
+        oldest_order = self.message_model.first_order()
+        if cached_range is None or oldest_order is None:
+            return
+        older = self.message_cache.load_before(key, oldest_order, OLDER_PAGE_SIZE)
+        if older:
+            self.prepend_messages(older)
+            return
+        if cached_range[2]:
+            return
+        self.loading_older = True
+        friend_name, before_order = self.friend_name, cached_range[0]
+        self.connection.request(
+            ["get_messages_page", self.username, friend_name, "", str(before_order), str(OLDER_PAGE_SIZE)],
+            lambda response: self.handle_older_page(friend_name, before_order, response))
+
+    def handle_older_page(self, friend_name, before_order, response):
+        self.loading_older = False
+        if friend_name != self.friend_name:
+            return
+        if response[0] != "page":
+            self.handle_messages_received(response)
+            return
+        key = conversation_id(self.username, friend_name)
+        cached_range = self.message_cache.get_range(key)
+        if cached_range is None or cached_range[0] != before_order:
+            return
+        messages = parse_messages(response[1])
+        self.message_cache.save(key, messages)
+        first_order = messages[0]["order"] if messages else before_order
+        self.message_cache.set_range(key, first_order, cached_range[1], len(messages) < OLDER_PAGE_SIZE)
+        self.prepend_messages(messages)
+
+    def prepend_messages(self, messages):
+        # Keeps the message that was at the top in view.
+        added = self.message_model.prepend_messages([self.to_model_message(message) for message in messages])
+        if added:
+            self.listMsg.scrollTo(self.message_model.index(added), QtWidgets.QAbstractItemView.PositionAtTop)
+
+    def to_model_message(self, message):
+        return Message(message["sender"], message["message"], message["message_type"], message["timestamp"],
+                       message["sender"] != self.username, message["file_hash"], message["order"])
+
+    def handle_new_message(self, sender, receiver, message, message_type, timestamp, order=None, file_hash=None):
+        if self.friend_name not in (sender, receiver):
+            return
+        order = parse_order(order)
+        if order is not None:
+            record = {"order": order, "sender": sender, "message": message, "message_type": message_type,
+                      "timestamp": timestamp, "file_hash": file_hash or None}
+            if self.synced:
+                self.cache_pushed([record])
+            else:
+                self.pending_pushes.append(record)
+        if sender == self.username and order is not None and self.message_model.confirm_message(message, timestamp, order):
+            return
+        self.add_message(sender, message, timestamp, message_type, sender != self.username, file_hash or None, order)
+        self.listMsg.scrollToBottom()
 
-    def handle_video_call_request(self, sender, receiver):
+    def handle_video_call_request(self, sender, receiver, call_id=None, media_port=None, join_token=None):
         if receiver == self.username:
             response = QMessageBox.question(
                 self, "Video Call Request", f"Do you want to accept a video call from {sender}?", 
                 QMessageBox.Yes | QMessageBox.No
             )
             if response == QMessageBox.Yes:
-                self.client_socket.send(f"call_video_response|{self.username}|{sender}|accept".encode())
+                self.connection.send(["call_video_response", self.username, sender, "accept", call_id or ""])
                 print(f"{self.username} accepts the call from {sender}")
-                video_call_window_receiver = CallVideo(sender, self.username, 1, True)  # Camera index for receiver
-                video_call_window_receiver.show()
+                self.open_video_call(sender, 1, True, call_id, media_port, join_token)  # Camera index for receiver
             else:
-                self.client_socket.send(f"call_video_response|{sender}|{self.username}|reject".encode())
+                self.connection.send(["call_video_response", self.username, sender, "reject", call_id or ""])
                 print(f"{self.username} rejects the call from {sender}")
 
-    def handle_video_call_response(self, sender, receiver, response):
+    def handle_video_call_response(self, sender, receiver, response, call_id=None, media_port=None, join_token=None):
         print(f"Got video call response: sender={sender}, receiver={receiver}, response={response}")
         if sender == self.username:
             if response == "accept":
                 print(f"{self.username} accepts the call from {receiver}")
-                video_call_window_caller = CallVideo(self.username, receiver, 0, False)  # Camera index for caller
-                video_call_window_caller.show()
-            elif sender == "reject":
+                if self.video_call is not None and self.video_call.isVisible() and self.video_call.call_id == call_id:
+                    # Someone joined the call we are already in.
+                    return
+                self.open_video_call(receiver, 0, False, call_id, media_port, join_token)  # Camera index for caller
+            elif response == "reject":
                 print(f"{self.username} rejects the call from {receiver}")
                 # Handle rejection if needed
 
+    def open_video_call(self, friend_name, camera_index, is_server, call_id=None, media_port=None, join_token=None):
+        relay_address = None
+        if call_id and media_port and join_token:
+            relay_address = (server_address[0], int(media_port))
+        else:
+            call_id = None
+        self.video_call = CallVideo(self.username, friend_name, camera_index, is_server, call_id, relay_address,
+                                    join_token)
+        self.video_call.show()
+
     def send_message(self):
         friend_name = self.txtNameFriend.text()
         message = self.txtMsg.text()
         message_type = 'text'
         timestamp = QtCore.QDateTime.currentDateTime().toString(Qt.DefaultLocaleLongDate)
-        self.client_socket.send(f"send_message|{self.username}|{friend_name}|{message}|{message_type}|{timestamp}".encode())
-        self.add_message("You", message, timestamp)
+        self.connection.send(["send_message", self.username, friend_name, message, message_type, timestamp])
+        self.add_message("You", message, timestamp, message_type)
         self.txtMsg.clear()
         self.listMsg.scrollToBottom()
 
     def add_friend(self):
         friend_username, ok_pressed = QInputDialog.getText(self, "Add Friend", "Enter friend's username:")
         if ok_pressed and friend_username:
-            self.client_socket.send(f"add_friend|{self.username}|{friend_username}".encode())
-            response = self.client_socket.recv(1024).decode()
-            if response == "add_friend_success":
-                QMessageBox.information(self, "Success", f"Friend {friend_username} added successfully!")
-                self.load_friends_list()
-            else:
-                QMessageBox.warning(self, "Error", f"Failed to add friend: {response}")
+            self.request_add_friend(friend_username)
+
+    def request_add_friend(self, friend_username):
+        self.connection.request(["add_friend", self.username, friend_username],
+                                lambda response: self.show_add_friend_result(friend_username, response))
+
+    def show_add_friend_result(self, friend_username, response):
+        if response[0] == "add_friend_success":
+            QMessageBox.information(self, "Success", f"Friend {friend_username} added successfully!")
+            self.load_friends_list()
+        else:
+            QMessageBox.warning(self, "Error", f"Failed to add friend: {' '.join(response)}")
+
+    def search_users(self):
+        prefix = self.txtSearch.text().strip()
+        if not prefix:
+            return
+        self.connection.request(["find_user", prefix], lambda response: self.show_search_results(prefix, response))
+
+    def show_search_results(self, prefix, response):
+        users = [user for user in response[1] if user and user != self.username] if len(response) > 1 else []
+        if not users:
+            QMessageBox.information(self, "Search", f"No users found for '{prefix}'.")
+            return
+        friend_username, ok_pressed = QInputDialog.getItem(self, "Add Friend", "Select a user to add:", users, 0, False)
+        if ok_pressed and friend_username:
+            self.request_add_friend(friend_username)
 
     def load_friends_list(self):
-        self.client_socket.send(f"list_friends|{self.username}".encode())
-        friends_data = self.client_socket.recv(1024).decode()
+        self.connection.request(["list_friends", self.username], self.show_friends_list)
 
+    def show_friends_list(self, response):
+        friends_data = response[0]
         if friends_data.startswith("No friends found."):
             QMessageBox.information(self, "Friends List", "No friends found.")
             return
@@ -207,89 +368,113 @@ class MainChat(QMainWindow):
             self.txtNameFriend.setText(new_friend_name)
             self.avtFriend.setText(new_friend_name)
             self.txtMsg.setEnabled(True)
-            self.listMsg.clear()
-            if (self.message_thread and self.message_thread.isRunning()):
-                print("Thread has been deleted.")
-                self.clearLoadMsgsThread()
-            self.message_thread = MessageThread(self.client_socket, self.username, new_friend_name)
-            self.message_thread.messages_received.connect(self.handle_messages_received)
-            self.message_thread.start()
-
-    def clearLoadMsgsThread(self):
-        self.message_thread.terminate()
-        self.message_thread.wait()
-        self.message_thread = None
-
-    def display_messages(self, messages_data):
-        messages_list = messages_data.split(";")
-        current_items_amount = self.listMsg.count()
-        if len(messages_list) != current_items_amount:
-            self.listMsg.clear()
-            for message in messages_list:
-                if message:
-                    message_parts = message.split("|")
-                    if len(message_parts) >= 3:
-                        sender, message_text, timestamp = message_parts[:3]
-                        message_type = message_parts[3] if len(message_parts) >= 4 else "text"
-                        received_message = sender != self.username
-                        self.add_message(sender, message_text, message_type, timestamp, received_message)
-                        self.listMsg.scrollToBottom()
-                        print(f"Added message: {sender}, {message_text}, {message_type}, {timestamp}, {received_message}")
-
-    def add_message(self, sender, message, timestamp, message_type, received_message=False):
-        item = QtWidgets.QListWidgetItem(self.listMsg)
-        item.setSizeHint(QtCore.QSize(150, 150))
-        widget = QtWidgets.QWidget(self.listMsg)
-        layout = QtWidgets.QVBoxLayout(widget)
-        chat_bubble = QtWidgets.QFrame()
-        chat_layout = QtWidgets.QHBoxLayout(chat_bubble)
-        chat_bubble.setStyleSheet(
-            "background-color: #E1FFC7; border: 1px solid #E1FFC7; border-radius: 15px; padding: 10px;"
-        )
-
-        if received_message:
-            avatar_label = self.create_avatar_label(sender)
-            chat_layout.addWidget(avatar_label)
-            QtWidgets.QApplication.processEvents()
-
-        message_container = QtWidgets.QWidget()
-        message_container_layout = QtWidgets.QVBoxLayout(message_container)
-        print(message_type)
-        try:
-            if message_type == "text":
-                message_label = self.create_message_label(message)
-                timestamp_label = self.create_timestamp_label(timestamp)
-                message_container_layout.addWidget(message_label)
-                message_container_layout.addWidget(timestamp_label)
-            elif message_type == "file":
-                message_label = self.create_message_label(message)
-                timestamp_label = self.create_timestamp_label(timestamp)
-                download_icon = self.create_download_icon_label(message)
-                message_container_layout.addWidget(message_label)
-                message_container_layout.addWidget(download_icon)
-                message_container_layout.addWidget(timestamp_label)
-                download_icon.mousePressEvent = lambda event: self.download_file(sender, message)
-            chat_layout.addWidget(message_container)
-
-            if not received_message:
-                layout.addStretch(1)
-
-            layout.addWidget(chat_bubble)
-            self.listMsg.addItem(item)
-            self.listMsg.setItemWidget(item, widget)
-        except Exception as e:
-            print(f"Error adding message: {str(e)}")
-
-    def create_download_icon_label(self, file_name):
+            # Show what we already have at once, then fetch only newer messages.
+            key = conversation_id(self.username, new_friend_name)
+            if self.message_cache.get_range(key) is None:
+                self.message_cache.clear(key)
+            self.synced = False
+            cached = self.message_cache.load(key, CACHE_RENDER_LIMIT)
+            self.message_model.set_messages([self.to_model_message(message) for message in cached])
+            self.listMsg.scrollToBottom()
+            self.sync_conversation()
+
+    def sync_conversation(self):
+        # With nothing cached the newest page comes first and older pages
+        # follow as the user scrolls up; otherwise only newer messages.
+        self.synced = False
+        self.pending_pushes = []
+        self.loading_older = False
+        cached_range = self.message_cache.get_range(conversation_id(self.username, self.friend_name))
+        if cached_range is None:
+            request = ["subscribe", self.username, self.friend_name, "latest", str(OLDER_PAGE_SIZE)]
+        else:
+            request = ["subscribe", self.username, self.friend_name, str(cached_range[1]), str(SYNC_PAGE_SIZE)]
+        self.connection.request(request, self.handle_messages_received)
+
+    def start_connection(self, framed_socket):
+        # One reader thread owns the socket; replies come back through
+        # request callbacks and pushes through message_received.
+        self.connection = Connection(framed_socket, self)
+        self.connection.message_received.connect(self.handle_messages_received)
+        self.connection.disconnected.connect(self.handle_disconnected)
+        self.connection.start()
+
+    def handle_disconnected(self):
+        if self.logging_out:
+            return
+        self.statusBar().showMessage("Disconnected from the server, reconnecting...")
+        QTimer.singleShot(RECONNECT_DELAY, self.reconnect)
+
+    def reconnect(self):
+        # Connecting and resuming run on their own thread so the window keeps
+        # responding while the server is slow or away.
+        threading.Thread(target=self.resume_session, name="reconnect", daemon=True).start()
+
+    def resume_session(self):
         try:
-            download_icon = QtWidgets.QLabel()
-            download_icon.setPixmap(QtGui.QPixmap(".\\Icon\iconDownload.png"))
-            download_icon.setToolTip(f"Download {file_name}")
-            download_icon.setAlignment(QtCore.Qt.AlignCenter)
-            return download_icon
-        except Exception as e:
-            print(f"Error creating download icon label: {str(e)}")
-            return QtWidgets.QLabel("Error creating label")
+            framed_socket = FramedSocket.connect(server_address, RESUME_TIMEOUT)
+            try:
+                framed_socket.settimeout(RESUME_TIMEOUT)
+                framed_socket.send_fields(["resume", self.session_token])
+                response = framed_socket.recv_fields()
+                if not response:
+                    raise ConnectionError("Server closed the connection")
+                framed_socket.settimeout(None)
+            except (OSError, ProtocolError):
+                framed_socket.close()
+                raise
+        except (OSError, ProtocolError) as e:
+            self.reconnect_finished.emit(None, str(e))
+            return
+        self.reconnect_finished.emit(framed_socket, response[0])
+
+    def handle_reconnected(self, framed_socket, response):
+        if self.logging_out:
+            if framed_socket is not None:
+                framed_socket.close()
+            return
+        if framed_socket is None:
+            print(f"Reconnect failed: {response}")
+            QTimer.singleShot(RECONNECT_DELAY, self.reconnect)
+            return
+        if response != "resume_success":
+            framed_socket.close()
+            self.statusBar().showMessage("Session expired, please log in again")
+            return
+        self.start_connection(framed_socket)
+        self.statusBar().clearMessage()
+        if self.friend_name:
+            self.sync_conversation()
+
+    def logout(self):
+        # The login window comes back first, or closing the last window
+        # would quit the application.
+        self.logged_out.emit()
+        self.close()
+
+    def closeEvent(self, event):
+        # Revoke the session, so its token can no longer be resumed.
+        if not self.logging_out:
+            self.logging_out = True
+            try:
+                self.connection.send(["logout", self.session_token])
+            except OSError:
+                pass
+            self.connection.close()
+        super().closeEvent(event)
+
+    def display_messages(self, items):
+        messages = []
+        for message_parts in items:
+            if isinstance(message_parts, list) and len(message_parts) >= 4:
+                sender, message_text, message_type, timestamp = message_parts[:4]
+                file_hash = message_parts[4] if len(message_parts) >= 5 and message_parts[4] else None
+                messages.append(Message(sender, message_text, message_type, timestamp, sender != self.username, file_hash))
+        self.message_model.set_messages(messages)
+        self.listMsg.scrollToBottom()
+
+    def add_message(self, sender, message, timestamp, message_type, received_message=False, file_hash=None, order=None):
+        self.message_model.append_message(Message(sender, message, message_type, timestamp, received_message, file_hash, order))
 
     def load_friend_widget(self, friend_name):
         item = QtWidgets.QListWidgetItem()
@@ -302,36 +487,16 @@ class MainChat(QMainWindow):
         self.listFriends.addItem(item)
         self.listFriends.setItemWidget(item, widget_friend)
 
-    def create_avatar_label(self, sender):
-        avatar_label = QtWidgets.QLabel()
-        avatar_label.setFixedSize(31, 31)
-        avatar_label.setStyleSheet(
-            "border: 1px solid #E1FFC7; background-color: white; border-radius: 15px;"
-        )
-        avatar_label.setAlignment(QtCore.Qt.AlignCenter)
-        avatar_label.setObjectName("avatar_label")
-        avatar_label.setText(sender[:3])
-        return avatar_label
-
-    def create_message_label(self, message):
-        message_label = QtWidgets.QLabel(message)
-        message_label.setStyleSheet(
-            "background-color: #E1FFC7; border: none; padding: 5px; color: black; font-family: Arial; font-size: 12px;"
-        )
-        return message_label
-
-    def create_timestamp_label(self, timestamp):
-        timestamp_label = QtWidgets.QLabel(timestamp)
-        timestamp_label.setStyleSheet(
-            "background-color: #E1FFC7; border: none; padding: 5px; color: gray; font-family: Arial; font-size: 10px;"
-        )
-        return timestamp_label
-
-def main(username):
-    app = QApplication(sys.argv)
-    main_chat = MainChat(username)
-    main_chat.show()
-    sys.exit(app.exec_())
+def parse_order(order):
+    try:
+        return int(order)
+    except (TypeError, ValueError):
+        return None
+
+def main():
+    # MainChat needs an authenticated connection, so start from the login window.
+    from Login import main as login_main
+    login_main()
 
 if __name__ == '__main__':
-    main('han1')
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+
+CLIENT_DATA_DIR = "ClientData"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    msg_order INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    file_hash TEXT,
+    PRIMARY KEY (conversation_id, msg_order)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ranges (
+    conversation_id TEXT PRIMARY KEY,
+    first_order INTEGER NOT NULL,
+    last_order INTEGER NOT NULL,
+    complete INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+class MessageCache:
+    # Local copy of the conversations a user has opened, one SQLite file per
+    # user. Only used from the GUI thread.
+    def __init__(self, username, data_dir=CLIENT_DATA_DIR):
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.path = os.path.join(data_dir, f"{username}.db")
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def load(self, conversation_id, limit=None):
+        # The newest `limit` messages (all when None), oldest first.
+        query = ("SELECT msg_order, sender, message, message_type, timestamp, file_hash FROM messages "
+                 "WHERE conversation_id = ? ORDER BY msg_order DESC")
+        params = (conversation_id,)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        rows = self.connection.execute(query, params).fetchall()
+        rows.reverse()
+        return [message_from_row(row) for row in rows]
+
+    def load_before(self, conversation_id, before_order, limit):
+        rows = self.connection.execute(
+            "SELECT msg_order, sender, message, message_type, timestamp, file_hash FROM messages "
+            "WHERE conversation_id = ? AND msg_order < ? ORDER BY msg_order DESC LIMIT ?",
+            (conversation_id, before_order, limit)).fetchall()
+        rows.reverse()
+        return [message_from_row(row) for row in rows]
+
+    def get_range(self, conversation_id):
+        # (first_order, last_order, complete): every message with an order in
+        # between is cached, and complete means there is nothing older on the
+        # server. None when nothing is known about the conversation.
+        row = self.connection.execute(
+            "SELECT first_order, last_order, complete FROM ranges WHERE conversation_id = ?",
+            (conversation_id,)).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def set_range(self, conversation_id, first_order, last_order, complete):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO ranges (conversation_id, first_order, last_order, complete) VALUES (?, ?, ?, ?)",
+                (conversation_id, first_order, last_order, int(complete)))
+
+    def clear(self, conversation_id):
+        # Messages cached without a range may have gaps, so they are dropped
+        # and loaded again.
+        with self.connection:
+            self.connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self.connection.execute("DELETE FROM ranges WHERE conversation_id = ?", (conversation_id,))
+
+    def save(self, conversation_id, messages):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO messages (conversation_id, msg_order, sender, message, message_type, timestamp, file_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(conversation_id, message["order"], message["sender"], message["message"], message["message_type"],
+                  message["timestamp"], message.get("file_hash")) for message in messages])
+
+    def close(self):
+        self.connection.close()
+
+def message_from_row(row):
+    return {
+        "order": row[0],
+        "sender": row[1],
+        "message": row[2],
+        "message_type": row[3],
+        "timestamp": row[4],
+        "file_hash": row[5]
+    }
+
+def conversation_id(sender, receiver):
+    return '-'.join(sorted([sender, receiver]))
+
+def parse_messages(items):
+    # Parses the [order, sender, message, type, timestamp(, file_hash)] lists
+    # sent in sync and page replies.
+    messages = []
+    for parts in items:
+        if not isinstance(parts, list) or len(parts) < 5 or not str(parts[0]).isdigit():
+            continue
+        messages.append({
+            "order": int(parts[0]),
+            "sender": parts[1],
+            "message": parts[2],
+            "message_type": parts[3],
+            "timestamp": parts[4],
+            "file_hash": parts[5] if len(parts) > 5 and parts[5] else None
+        })
+    return messages
@@ -0,0 +1,217 @@
+from PyQt5.QtCore import QAbstractListModel, QEvent, QModelIndex, QRect, QRectF, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QFont, QFontMetrics, QPainter, QPainterPath, QPixmap
+from PyQt5.QtWidgets import QStyledItemDelegate
+
+MessageRole = Qt.UserRole + 1
+
+BUBBLE_COLOR = QColor("#E1FFC7")
+AVATAR_COLOR = QColor("white")
+TEXT_COLOR = QColor("black")
+TIMESTAMP_COLOR = QColor("gray")
+AVATAR_SIZE = 31
+BUBBLE_RADIUS = 15
+PADDING = 10
+SPACING = 5
+MARGIN = 6
+# Bubbles never get wider than this share of the view.
+MAX_BUBBLE_WIDTH = 0.7
+DOWNLOAD_ICON_PATH = ".\\Icon\\iconDownload.png"
+DOWNLOAD_ICON_SIZE = 24
+
+class Message:
+    __slots__ = ("sender", "text", "message_type", "timestamp", "received", "file_hash", "order", "size_cache")
+
+    def __init__(self, sender, text, message_type, timestamp, received=False, file_hash=None, order=None):
+        self.sender = sender
+        self.text = text
+        self.message_type = message_type
+        self.timestamp = timestamp
+        self.received = received
+        self.file_hash = file_hash
+        self.order = order
+        # (view width, QSize) of the last size hint, so scrolling does not
+        # measure the same text again.
+        self.size_cache = None
+
+class MessageModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+        self.orders = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.messages):
+            return None
+        message = self.messages[index.row()]
+        if role == MessageRole:
+            return message
+        if role == Qt.DisplayRole:
+            return message.text
+        if role == Qt.ToolTipRole:
+            return f"{message.sender} - {message.timestamp}"
+        return None
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.orders = {message.order for message in self.messages if message.order is not None}
+        self.endResetModel()
+
+    def first_order(self):
+        return min(self.orders) if self.orders else None
+
+    def prepend_messages(self, messages):
+        # Older messages loaded while scrolling up go before everything else.
+        messages = [message for message in messages if message.order not in self.orders]
+        if not messages:
+            return 0
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[0:0] = messages
+        self.orders.update(message.order for message in messages if message.order is not None)
+        self.endInsertRows()
+        return len(messages)
+
+    def confirm_message(self, text, timestamp, order):
+        # Gives the local echo of a message we sent the order the server gave
+        # it. Returns False when there is no such echo to update.
+        if order in self.orders:
+            return True
+        for row, message in enumerate(self.messages):
+            if message.order is None and not message.received and message.text == text and message.timestamp == timestamp:
+                message.order = order
+                self.orders.add(order)
+                self.dataChanged.emit(self.index(row), self.index(row))
+                return True
+        return False
+
+    def append_message(self, message):
+        # Messages from the server carry their order; one we already have is
+        # not added twice, and one that arrives late is put in its place.
+        row = len(self.messages)
+        if message.order is not None:
+            if message.order in self.orders:
+                return False
+            self.orders.add(message.order)
+            # Local echoes (no order yet) stay where they are.
+            while row > 0 and self.messages[row - 1].order is not None and self.messages[row - 1].order > message.order:
+                row -= 1
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.insert(row, message)
+        self.endInsertRows()
+        return True
+
+class BubbleDelegate(QStyledItemDelegate):
+    # Paints each message as a chat bubble straight onto the view, so only
+    # the rows on screen cost anything.
+    download_requested = pyqtSignal(str, str, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.text_font = QFont("Arial", 12)
+        self.timestamp_font = QFont("Arial", 10)
+        self.avatar_font = QFont("Arial", 9)
+        self.text_metrics = QFontMetrics(self.text_font)
+        self.timestamp_metrics = QFontMetrics(self.timestamp_font)
+        self.download_icon = None
+
+    def icon(self):
+        if self.download_icon is None:
+            self.download_icon = QPixmap(DOWNLOAD_ICON_PATH).scaled(
+                DOWNLOAD_ICON_SIZE, DOWNLOAD_ICON_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        return self.download_icon
+
+    def bubble_layout(self, message, rect):
+        # Returns the bubble, text, icon, timestamp and avatar rectangles of a
+        # message drawn inside rect (icon and avatar may be None).
+        avatar_width = AVATAR_SIZE + SPACING if message.received else 0
+        max_text_width = max(int(rect.width() * MAX_BUBBLE_WIDTH) - avatar_width - 2 * PADDING, 50)
+        text_rect = self.text_metrics.boundingRect(QRect(0, 0, max_text_width, 100000), Qt.TextWordWrap, message.text)
+        timestamp_rect = self.timestamp_metrics.boundingRect(message.timestamp)
+        content_width = max(text_rect.width(), timestamp_rect.width())
+        content_height = text_rect.height() + SPACING + timestamp_rect.height()
+        if message.message_type == "file":
+            content_width = max(content_width, DOWNLOAD_ICON_SIZE)
+            content_height += DOWNLOAD_ICON_SIZE + SPACING
+
+        bubble_width = content_width + 2 * PADDING
+        bubble_height = content_height + 2 * PADDING
+        if message.received:
+            left = rect.left() + MARGIN + avatar_width
+        else:
+            left = rect.right() - MARGIN - bubble_width
+        top = rect.top() + MARGIN
+        bubble = QRect(left, top, bubble_width, bubble_height)
+
+        y = top + PADDING
+        text = QRect(left + PADDING, y, content_width, text_rect.height())
+        y += text_rect.height() + SPACING
+        icon = None
+        if message.message_type == "file":
+            icon = QRect(left + PADDING, y, DOWNLOAD_ICON_SIZE, DOWNLOAD_ICON_SIZE)
+            y += DOWNLOAD_ICON_SIZE + SPACING
+        timestamp = QRect(left + PADDING, y, content_width, timestamp_rect.height())
+        avatar = None
+        if message.received:
+            avatar = QRect(rect.left() + MARGIN, top, AVATAR_SIZE, AVATAR_SIZE)
+        return bubble, text, icon, timestamp, avatar
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageRole)
+        if message is None:
+            return super().sizeHint(option, index)
+        # Wrap to the viewport: option.rect is not laid out yet when sizes
+        # are asked for.
+        view = self.parent()
+        width = view.viewport().width() if view is not None else option.rect.width()
+        if message.size_cache is not None and message.size_cache[0] == width:
+            return message.size_cache[1]
+        bubble = self.bubble_layout(message, QRect(0, 0, width, 0))[0]
+        size = QSize(width, max(bubble.height(), AVATAR_SIZE) + 2 * MARGIN)
+        message.size_cache = (width, size)
+        return size
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        if message is None:
+            return super().paint(painter, option, index)
+        bubble, text, icon, timestamp, avatar = self.bubble_layout(message, option.rect)
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+
+        path = QPainterPath()
+        path.addRoundedRect(QRectF(bubble), BUBBLE_RADIUS, BUBBLE_RADIUS)
+        painter.fillPath(path, BUBBLE_COLOR)
+
+        if avatar is not None:
+            painter.setBrush(AVATAR_COLOR)
+            painter.setPen(BUBBLE_COLOR)
+            painter.drawEllipse(avatar)
+            painter.setPen(TEXT_COLOR)
+            painter.setFont(self.avatar_font)
+            painter.drawText(avatar, Qt.AlignCenter, message.sender[:3])
+
+        painter.setPen(TEXT_COLOR)
+        painter.setFont(self.text_font)
+        painter.drawText(text, Qt.TextWordWrap, message.text)
+        if icon is not None:
+            painter.drawPixmap(icon, self.icon())
+        painter.setPen(TIMESTAMP_COLOR)
+        painter.setFont(self.timestamp_font)
+        painter.drawText(timestamp, Qt.AlignLeft, message.timestamp)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            message = index.data(MessageRole)
+            if message is not None and message.message_type == "file":
+                icon = self.bubble_layout(message, option.rect)[2]
+                if icon.contains(event.pos()):
+                    self.download_requested.emit(message.sender, message.text, message.file_hash)
+                    return True
+        return super().editorEvent(event, model, option, index)
@@ -1,7 +1,5 @@
 import cv2
-import pickle
 import socket
-import struct
 import sys
 import threading
 import time
@@ -9,6 +7,8 @@ from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel
 from PyQt5.uic import loadUi
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from VideoCodec import get_codec, get_decoder
+from VideoTransport import FrameReader, send_frame
 
 class VideoDisplaySignal(QObject):
     signal = pyqtSignal(QPixmap, object)
@@ -35,6 +35,8 @@ class VideoCallApp(QMainWindow):
         self.lbMyCam = self.findChild(QLabel, 'lbMyCam')
 
         self.camera = cv2.VideoCapture(0)
+        self.codec = get_codec("jpeg")
+        self.decoders = {}
         # self.camera = cv2.VideoCapture(1)
         self.is_camera_on = True
         self.is_micro_on = True
@@ -67,23 +69,20 @@ class VideoCallApp(QMainWindow):
         self.is_micro_on = not self.is_micro_on
 
     def receive_video(self):
+        reader = FrameReader(self.client_socket)
         try:
             while True:
-                payload_size = struct.unpack(">L", self.client_socket.recv(4))[0]
+                received = reader.read_frame()
+                if received is None:
+                    print("Connection closed while receiving frame data.")
+                    return
+                codec_id, frame_data = received
 
-                if payload_size == 0:
+                if len(frame_data) == 0:
                     # Received end video call message
                     break
 
-                frame_data = b""
-                while len(frame_data) < payload_size:
-                    chunk = self.client_socket.recv(4096)
-                    if not chunk:
-                        print("Connection closed while receiving frame data.")
-                        return
-                    frame_data += chunk
-
-                frame = pickle.loads(frame_data)
+                frame = get_decoder(codec_id, self.decoders).decode(frame_data)
 
                 if frame is not None:
                     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -106,15 +105,14 @@ class VideoCallApp(QMainWindow):
                 if self.is_camera_on:
                     ret, frame = self.camera.read()
                     if ret:
+                        frame_data = self.codec.encode(frame)
+                        send_frame(self.client_socket, self.codec.codec_id, frame_data)
+
                         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
                         img = QImage(frame, frame.shape[1], frame.shape[0], QImage.Format_RGB888)
                         pixmap = QPixmap.fromImage(img)
                         self.display_video_signal.signal.emit(pixmap, self.lbMyCam)
 
-                        frame_data = pickle.dumps(frame)
-                        sent_size = struct.pack(">L", len(frame_data))
-                        self.client_socket.send(sent_size + frame_data)
-
                 time.sleep(0.1)
         except Exception as e:
             print(f"Lỗi khi gửi video: {str(e)}")
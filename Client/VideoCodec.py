@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+
+class FrameCodec:
+    codec_id = 0
+    name = None
+    # True when every encoded frame can be decoded on its own (a keyframe).
+    intra_only = False
+
+    def encode(self, frame):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def request_keyframe(self):
+        # Intra-only codecs have nothing to do; inter-frame codecs should make
+        # the next encoded frame decodable on its own.
+        pass
+
+class JpegCodec(FrameCodec):
+    codec_id = 1
+    name = "jpeg"
+    intra_only = True
+
+    def __init__(self, quality=70, width=640, height=480):
+        self.quality = quality
+        self.width = width
+        self.height = height
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def encode(self, frame):
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", frame, self.encode_params)
+        if not ok:
+            raise ValueError("JPEG encoding failed")
+        return encoded.tobytes()
+
+    def decode(self, data):
+        # Returns None for data that is not a valid JPEG instead of raising,
+        # so one corrupt frame does not end the call.
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+CODECS = {codec.codec_id: codec for codec in (JpegCodec,)}
+CODEC_NAMES = {codec.name: codec for codec in (JpegCodec,)}
+
+def get_codec(name="jpeg", **options):
+    if name not in CODEC_NAMES:
+        raise ValueError(f"Unknown video codec: {name}")
+    return CODEC_NAMES[name](**options)
+
+def get_decoder(codec_id, decoders):
+    # decoders caches one instance per codec id for the receiving side.
+    if codec_id not in decoders:
+        if codec_id not in CODECS:
+            raise ValueError(f"Unknown video codec id: {codec_id}")
+        decoders[codec_id] = CODECS[codec_id]()
+    return decoders[codec_id]
@@ -0,0 +1,139 @@
+import threading
+import time
+
+class LatestSlot:
+    # A queue of one: put replaces whatever has not been taken yet, so a slow
+    # consumer always gets the newest item and never falls behind.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.has_item = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.has_item:
+                self.dropped += 1
+            self.item = item
+            self.has_item = True
+            self.condition.notify()
+
+    def get(self):
+        # Returns None once the slot is closed.
+        with self.condition:
+            while not self.has_item and not self.closed:
+                self.condition.wait()
+            if not self.has_item:
+                return None
+            item = self.item
+            self.item = None
+            self.has_item = False
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class VideoPipeline:
+    # capture -> encode -> network, with capture also feeding the local
+    # preview. Each stage runs on its own thread and hands over through a
+    # LatestSlot, so a slow stage drops frames instead of adding latency.
+    def __init__(self, camera, codec, transport, on_preview=None, fps=30):
+        self.camera = camera
+        self.codec = codec
+        self.transport = transport
+        self.on_preview = on_preview
+        self.frame_interval = 1 / fps if fps else 0
+        self.paused = False
+        self.running = False
+        self.encode_slot = LatestSlot()
+        self.send_slot = LatestSlot()
+        self.preview_slot = LatestSlot()
+        self.captured = 0
+        self.sent = 0
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        stages = [self.capture, self.encode, self.send]
+        if self.on_preview is not None:
+            stages.append(self.preview)
+        for stage in stages:
+            thread = threading.Thread(target=stage, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for slot in (self.encode_slot, self.send_slot, self.preview_slot):
+            slot.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.threads = []
+
+    def capture(self):
+        next_frame = time.monotonic()
+        while self.running:
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_frame = max(next_frame + self.frame_interval, time.monotonic())
+            if self.paused:
+                continue
+            ret, frame = self.camera.read()
+            if not ret:
+                print("Camera stopped delivering frames")
+                break
+            self.captured += 1
+            self.encode_slot.put(frame)
+            if self.on_preview is not None:
+                self.preview_slot.put(frame)
+        self.encode_slot.close()
+        self.preview_slot.close()
+
+    def encode(self):
+        while True:
+            frame = self.encode_slot.get()
+            if frame is None:
+                break
+            try:
+                if self.transport.take_keyframe_request():
+                    self.codec.request_keyframe()
+                self.send_slot.put(self.codec.encode(frame))
+            except Exception as e:
+                print(f"Error encoding video frame: {e}")
+        self.send_slot.close()
+
+    def send(self):
+        while True:
+            frame_data = self.send_slot.get()
+            if frame_data is None:
+                break
+            try:
+                self.transport.send_frame(self.codec.codec_id, frame_data, self.codec.intra_only)
+                self.sent += 1
+            except OSError as e:
+                print(f"Error sending video frame: {e}")
+                break
+
+    def preview(self):
+        while True:
+            frame = self.preview_slot.get()
+            if frame is None:
+                break
+            try:
+                self.on_preview(frame)
+            except Exception as e:
+                print(f"Error showing preview: {e}")
+
+    def stats(self):
+        return {
+            "captured": self.captured,
+            "sent": self.sent,
+            "dropped_before_encode": self.encode_slot.dropped,
+            "dropped_before_send": self.send_slot.dropped,
+            "dropped_before_preview": self.preview_slot.dropped
+        }
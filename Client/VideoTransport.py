@@ -0,0 +1,438 @@
+import argparse
+import heapq
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import MEDIA_CONTROL, MEDIA_HEADER, RELAY_HEADER
+
+# Each video frame on a stream socket: payload length, codec id, payload.
+FRAME_HEADER = MEDIA_HEADER
+MAX_VIDEO_FRAME_SIZE = 16 * 1024 * 1024
+
+# Each datagram: packet type, codec id, frame id, packet index, packet count.
+PACKET_HEADER = struct.Struct(">BBIHH")
+PACKET_FRAME = 1
+PACKET_KEYFRAME = 2
+PACKET_KEYFRAME_REQUEST = 3
+PACKET_BYE = 4
+# Stays under the usual 1280-1500 byte path MTU so frames never rely on IP fragmentation.
+DATAGRAM_SIZE = 1200
+JITTER_DELAY = 0.06
+MAX_PENDING_FRAMES = 30
+KEYFRAME_REQUEST_INTERVAL = 0.5
+
+def send_frame(sock, codec_id, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload), codec_id) + payload)
+
+class FrameReader:
+    def __init__(self, sock, header=FRAME_HEADER, buffer_size=1024 * 1024, max_frame_size=MAX_VIDEO_FRAME_SIZE):
+        # header is a Struct whose first field is the payload length.
+        self.sock = sock
+        self.header = header
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        # Returns the header fields after the length followed by the payload,
+        # (codec_id, payload) for FRAME_HEADER. The payload is a memoryview
+        # into the receive buffer and stays valid only until the next call.
+        # Returns None when the peer closes the connection.
+        header = self.header
+        while True:
+            available = self.end - self.start
+            if available >= header.size:
+                fields = header.unpack_from(self.buffer, self.start)
+                size = fields[0]
+                if size > self.max_frame_size:
+                    raise ValueError(f"Video frame of {size} bytes is too large")
+                total = header.size + size
+                if available >= total:
+                    payload = self.view[self.start + header.size:self.start + total]
+                    self.start += total
+                    return fields[1:] + (payload,)
+                self.reserve(total)
+            elif self.end == len(self.buffer):
+                self.reserve(header.size)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return None
+            self.end += received
+
+    def reserve(self, total):
+        # Makes room for a frame of `total` bytes starting at self.start by
+        # moving the unread bytes to the front, growing only when a frame is
+        # bigger than the whole buffer.
+        if len(self.buffer) - self.start >= total:
+            return
+        unread = self.end - self.start
+        if len(self.buffer) >= total:
+            self.buffer[:unread] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(max(total, len(self.buffer) * 2))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = unread
+
+class StreamTransport:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader(sock)
+
+    def connect(self):
+        pass
+
+    def read_frame(self):
+        # Transports return (stream_id, codec_id, payload); a direct call has
+        # a single remote stream, numbered 0.
+        received = self.reader.read_frame()
+        if received is None:
+            return None
+        return (0,) + received
+
+    def send_frame(self, codec_id, payload, keyframe=True):
+        send_frame(self.sock, codec_id, payload)
+        return True
+
+    def take_keyframe_request(self):
+        return False
+
+    def close(self):
+        self.sock.close()
+
+class RelayTransport:
+    # Connection to the server's media relay. Every participant of the call
+    # sends one stream and receives everyone else's, tagged with stream ids.
+    def __init__(self, sock, call_id, username, join_token, on_event=None):
+        self.sock = sock
+        self.call_id = call_id
+        self.username = username
+        # Issued by the relay for this user and call, sent to us by the server.
+        self.join_token = join_token
+        # on_event(kind, stream_id, username) for "joined" and "left".
+        self.on_event = on_event
+        self.reader = FrameReader(sock, RELAY_HEADER)
+        self.keyframe_requested = False
+
+    def connect(self):
+        self.send_control(f"join|{self.call_id}|{self.username}|{self.join_token}")
+
+    def send_control(self, text):
+        send_frame(self.sock, MEDIA_CONTROL, text.encode('utf-8'))
+
+    def read_frame(self):
+        while True:
+            received = self.reader.read_frame()
+            if received is None:
+                return None
+            codec_id, stream_id, payload = received
+            if codec_id != MEDIA_CONTROL:
+                return stream_id, codec_id, payload
+            parts = bytes(payload).decode('utf-8', errors='replace').split("|")
+            if parts[0] == "keyframe":
+                self.keyframe_requested = True
+            elif parts[0] in ("joined", "left") and len(parts) >= 3:
+                if self.on_event is not None:
+                    self.on_event(parts[0], int(parts[1]), parts[2])
+            elif parts[0] == "error":
+                print(f"Media relay refused the call: {'|'.join(parts[1:])}")
+                return None
+
+    def send_frame(self, codec_id, payload, keyframe=True):
+        send_frame(self.sock, codec_id, payload)
+        return True
+
+    def take_keyframe_request(self):
+        requested = self.keyframe_requested
+        self.keyframe_requested = False
+        return requested
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class PendingFrame:
+    __slots__ = ("codec_id", "keyframe", "parts", "missing", "first_seen")
+
+    def __init__(self, codec_id, keyframe, count, first_seen):
+        self.codec_id = codec_id
+        self.keyframe = keyframe
+        self.parts = [None] * count
+        self.missing = count
+        self.first_seen = first_seen
+
+class JitterBuffer:
+    def __init__(self, delay=JITTER_DELAY, max_frames=MAX_PENDING_FRAMES):
+        self.delay = delay
+        self.max_frames = max_frames
+        self.frames = {}
+        # Id of the last frame that was delivered or given up on; anything at
+        # or below it arrives too late to be shown.
+        self.last_frame_id = None
+        self.need_keyframe = True
+        self.delivered = 0
+        self.dropped = 0
+        self.late_packets = 0
+
+    def add(self, frame_id, index, count, codec_id, keyframe, data, now):
+        if self.last_frame_id is not None and frame_id <= self.last_frame_id:
+            self.late_packets += 1
+            return
+        frame = self.frames.get(frame_id)
+        if frame is None:
+            if index >= count:
+                return
+            frame = PendingFrame(codec_id, keyframe, count, now)
+            self.frames[frame_id] = frame
+        if index >= len(frame.parts) or frame.parts[index] is not None:
+            return
+        frame.parts[index] = data
+        frame.missing -= 1
+
+    def pop(self, now):
+        # Returns the next frame to show as (codec_id, payload), or None when
+        # the oldest pending frame is still worth waiting for.
+        while self.frames:
+            frame_id = min(self.frames)
+            frame = self.frames[frame_id]
+            in_order = self.last_frame_id is None or frame_id == self.last_frame_id + 1
+            expired = now - frame.first_seen >= self.delay or len(self.frames) > self.max_frames
+            if (frame.missing or not in_order) and not expired:
+                return None
+            del self.frames[frame_id]
+            if not in_order:
+                self.dropped += frame_id - self.last_frame_id - 1
+                self.need_keyframe = True
+            self.last_frame_id = frame_id
+            if frame.missing:
+                self.dropped += 1
+                self.need_keyframe = True
+                continue
+            if frame.keyframe:
+                self.need_keyframe = False
+            elif self.need_keyframe:
+                # Depends on a frame we never got; wait for the next keyframe.
+                self.dropped += 1
+                continue
+            self.delivered += 1
+            return frame.codec_id, b"".join(frame.parts)
+        return None
+
+class DatagramTransport:
+    def __init__(self, sock, peer_address=None, datagram_size=DATAGRAM_SIZE, jitter_delay=JITTER_DELAY):
+        self.sock = sock
+        # Without a peer address (the answering side) the first packet received
+        # decides who we talk to.
+        self.peer_address = peer_address
+        self.chunk_size = datagram_size - PACKET_HEADER.size
+        self.jitter = JitterBuffer(jitter_delay)
+        self.buffer = bytearray(65536)
+        self.view = memoryview(self.buffer)
+        self.frame_id = 0
+        self.keyframe_requested = False
+        self.last_keyframe_request = 0
+        self.closed = False
+        self.sock.settimeout(jitter_delay / 2)
+
+    def connect(self):
+        # Doubles as a hello so the answering side learns our address.
+        self.send_control(PACKET_KEYFRAME_REQUEST)
+        self.last_keyframe_request = time.monotonic()
+
+    def send_control(self, packet_type):
+        if self.peer_address is not None:
+            self.sock.sendto(PACKET_HEADER.pack(packet_type, 0, 0, 0, 0), self.peer_address)
+
+    def send_frame(self, codec_id, payload, keyframe=True):
+        if self.peer_address is None:
+            return False
+        payload = memoryview(payload)
+        count = max(1, -(-len(payload) // self.chunk_size))
+        if count > 0xFFFF:
+            raise ValueError(f"Video frame of {len(payload)} bytes is too large")
+        self.frame_id += 1
+        packet_type = PACKET_KEYFRAME if keyframe else PACKET_FRAME
+        for index in range(count):
+            chunk = payload[index * self.chunk_size:(index + 1) * self.chunk_size]
+            header = PACKET_HEADER.pack(packet_type, codec_id, self.frame_id, index, count)
+            self.sock.sendto(header + chunk, self.peer_address)
+        return True
+
+    def take_keyframe_request(self):
+        requested = self.keyframe_requested
+        self.keyframe_requested = False
+        return requested
+
+    def read_frame(self):
+        # Returns (stream_id, codec_id, payload) like StreamTransport, or None
+        # once the peer says goodbye or the socket is closed.
+        while True:
+            now = time.monotonic()
+            frame = self.jitter.pop(now)
+            if self.jitter.need_keyframe and now - self.last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+                self.last_keyframe_request = now
+                self.send_control(PACKET_KEYFRAME_REQUEST)
+            if frame is not None:
+                return (0,) + frame
+            if self.closed:
+                return None
+            try:
+                size, address = self.sock.recvfrom_into(self.buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                return None
+            if size < PACKET_HEADER.size:
+                continue
+            if self.peer_address is None:
+                self.peer_address = address
+            elif address != self.peer_address:
+                continue
+            packet_type, codec_id, frame_id, index, count = PACKET_HEADER.unpack_from(self.buffer)
+            if packet_type == PACKET_BYE:
+                return None
+            elif packet_type == PACKET_KEYFRAME_REQUEST:
+                self.keyframe_requested = True
+            elif packet_type in (PACKET_FRAME, PACKET_KEYFRAME):
+                data = bytes(self.view[PACKET_HEADER.size:size])
+                self.jitter.add(frame_id, index, count, codec_id, packet_type == PACKET_KEYFRAME, data, time.monotonic())
+
+    def stats(self):
+        return {
+            "frames_sent": self.frame_id,
+            "frames_delivered": self.jitter.delivered,
+            "frames_dropped": self.jitter.dropped,
+            "late_packets": self.jitter.late_packets
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_control(PACKET_BYE)
+        except OSError:
+            pass
+        self.sock.close()
+
+class LossySocket:
+    # Wraps a datagram socket and drops, delays and reorders outgoing packets
+    # to try the transport on loopback under network conditions.
+    def __init__(self, sock, loss=0.0, delay=0.0, jitter=0.0, seed=None):
+        self.sock = sock
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.deliver, daemon=True)
+        self.thread.start()
+
+    def sendto(self, data, address):
+        if self.random.random() < self.loss:
+            return len(data)
+        due = time.monotonic() + self.delay + self.random.random() * self.jitter
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.queue, (due, self.sequence, bytes(data), address))
+            self.condition.notify()
+        return len(data)
+
+    def deliver(self):
+        with self.condition:
+            while not self.closed:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                wait = self.queue[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, data, address = heapq.heappop(self.queue)
+                try:
+                    self.sock.sendto(data, address)
+                except OSError:
+                    pass
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def loopback_demo(frames=300, frame_size=20000, fps=30, loss=0.02, delay=0.02, jitter=0.03):
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_socket.bind(("127.0.0.1", 0))
+    sender_socket = LossySocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), loss, delay, jitter, seed=1)
+    sender_socket.bind(("127.0.0.1", 0))
+    receiver = DatagramTransport(receiver_socket)
+    sender = DatagramTransport(sender_socket, receiver_socket.getsockname())
+    sender.connect()
+
+    latencies = []
+    def receive():
+        while True:
+            frame = receiver.read_frame()
+            if frame is None:
+                break
+            sent_at, = struct.unpack_from(">d", frame[2])
+            latencies.append(time.monotonic() - sent_at)
+    receive_thread = threading.Thread(target=receive)
+    receive_thread.start()
+    # The sender only learns about keyframe requests while it reads.
+    feedback_thread = threading.Thread(target=sender.read_frame)
+    feedback_thread.start()
+
+    keyframe_requests = 0
+    filler = os.urandom(frame_size)
+    for _ in range(frames):
+        if sender.take_keyframe_request():
+            keyframe_requests += 1
+        sender.send_frame(1, struct.pack(">d", time.monotonic()) + filler)
+        time.sleep(1 / fps)
+    time.sleep(delay + jitter + JITTER_DELAY * 2)
+    sender.close()
+    receiver.close()
+    receive_thread.join()
+    feedback_thread.join()
+
+    stats = receiver.stats()
+    stats["frames_sent"] = sender.frame_id
+    stats["keyframe_requests"] = keyframe_requests
+    if latencies:
+        latencies.sort()
+        stats["latency_p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 1)
+        stats["latency_max_ms"] = round(latencies[-1] * 1000, 1)
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send synthetic video frames over loopback UDP with simulated loss.")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--frame-size", type=int, default=20000)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--loss", type=float, default=0.02, help="probability of dropping each packet")
+    parser.add_argument("--delay", type=float, default=0.02, help="base one-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.03, help="extra random delay in seconds")
+    args = parser.parse_args()
+    stats = loopback_demo(args.frames, args.frame_size, args.fps, args.loss, args.delay, args.jitter)
+    for key, value in stats.items():
+        print(f"{key}: {value}")
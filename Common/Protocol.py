@@ -0,0 +1,204 @@
+import json
+import socket
+import struct
+import threading
+import zlib
+from collections import deque
+
+# Every connection that speaks the framed protocol starts with HELLO. The
+# server answers with its own HELLO carrying the version it picked; anything
+# else as the first bytes is treated as a legacy pipe-delimited client.
+MAGIC = b"PYCF"
+PROTOCOL_VERSION = 2
+HELLO_SIZE = len(MAGIC) + 1
+# From version 2 a text frame of the chat connection holds a JSON array of
+# fields instead of "|"-joined text, so a field can hold any character. A field
+# can itself be a list, e.g. of messages that are each a list of fields.
+FIELDS_VERSION = 2
+
+# Frame header: payload length, frame type, request id (0 = not a reply).
+HEADER = struct.Struct(">IBI")
+FRAME_TEXT = 1
+FRAME_BINARY = 2
+FRAME_TYPES = (FRAME_TEXT, FRAME_BINARY)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# File chunks travel as binary frames: file offset, CRC32 of the data, data.
+CHUNK_HEADER = struct.Struct(">QI")
+CHUNK_SIZE = 256 * 1024
+# Downloads are sent as plain binary frames of at most this many bytes.
+DOWNLOAD_FRAME_SIZE = 1024 * 1024
+
+# Call media. Participants send frames of (payload length, codec id) to the
+# relay, which forwards them as (payload length, codec id, stream id) where the
+# stream id names the sender. Codec id 0 marks a control frame with a text
+# payload such as "join|<call id>|<username>|<join token>".
+MEDIA_HEADER = struct.Struct(">LB")
+RELAY_HEADER = struct.Struct(">LBH")
+MEDIA_CONTROL = 0
+
+class ProtocolError(Exception):
+    pass
+
+class Frame:
+    __slots__ = ("frame_type", "request_id", "payload")
+
+    def __init__(self, frame_type, request_id, payload):
+        self.frame_type = frame_type
+        self.request_id = request_id
+        self.payload = payload
+
+    def text(self):
+        return bytes(self.payload).decode('utf-8', errors='replace')
+
+def hello(version=PROTOCOL_VERSION):
+    return MAGIC + bytes([version])
+
+def parse_hello(data):
+    if len(data) < HELLO_SIZE or not data.startswith(MAGIC):
+        return None
+    return data[len(MAGIC)]
+
+def is_hello_prefix(data):
+    return MAGIC.startswith(bytes(data[:len(MAGIC)]))
+
+def encode_frame(frame_type, payload, request_id=0):
+    return HEADER.pack(len(payload), frame_type, request_id) + payload
+
+def encode_text(text, request_id=0):
+    return encode_frame(FRAME_TEXT, text.encode('utf-8'), request_id)
+
+def join_fields(fields):
+    # The "|"-joined text that legacy and version 1 clients read; the items
+    # of a list field are joined with ";".
+    texts = []
+    for field in fields:
+        if isinstance(field, (list, tuple)):
+            field = ";".join(item if isinstance(item, str) else "|".join(str(value) for value in item)
+                             for item in field)
+        texts.append(str(field))
+    return "|".join(texts)
+
+def fields_text(fields, version):
+    if version >= FIELDS_VERSION:
+        return json.dumps(list(fields), ensure_ascii=False)
+    return join_fields(fields)
+
+def parse_fields(text, version):
+    if version < FIELDS_VERSION:
+        return text.split("|")
+    try:
+        fields = json.loads(text)
+    except ValueError:
+        raise ProtocolError("Text frame is not a JSON array")
+    if not isinstance(fields, list) or not fields:
+        raise ProtocolError("Text frame is not a JSON array of fields")
+    return fields
+
+def encode_chunk(offset, data):
+    return CHUNK_HEADER.pack(offset, zlib.crc32(data)) + data
+
+def decode_chunk(payload):
+    if len(payload) < CHUNK_HEADER.size:
+        raise ProtocolError("Chunk frame is too short")
+    offset, checksum = CHUNK_HEADER.unpack_from(payload)
+    data = memoryview(payload)[CHUNK_HEADER.size:]
+    return offset, data, zlib.crc32(data) == checksum
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer += data
+        return self.frames()
+
+    def frames(self):
+        frames = []
+        offset = 0
+        buffer_size = len(self.buffer)
+        while buffer_size - offset >= HEADER.size:
+            length, frame_type, request_id = HEADER.unpack_from(self.buffer, offset)
+            if frame_type not in FRAME_TYPES or length > self.max_frame_size:
+                raise ProtocolError(f"Invalid frame header: type={frame_type} length={length}")
+            end = offset + HEADER.size + length
+            if end > buffer_size:
+                break
+            frames.append(Frame(frame_type, request_id, bytes(self.buffer[offset + HEADER.size:end])))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+class FramedSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+        self.send_lock = threading.Lock()
+        self.version = None
+
+    @classmethod
+    def connect(cls, address, timeout=10):
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        framed_socket = cls(sock)
+        framed_socket.handshake()
+        sock.settimeout(None)
+        return framed_socket
+
+    def handshake(self):
+        self.sock.sendall(hello())
+        data = b""
+        while len(data) < HELLO_SIZE:
+            chunk = self.sock.recv(HELLO_SIZE - len(data))
+            if not chunk:
+                raise ProtocolError("Server closed the connection during handshake")
+            data += chunk
+        self.version = parse_hello(data)
+        if self.version is None:
+            raise ProtocolError("Server does not support the framed protocol")
+
+    def send_frame(self, frame_type, payload, request_id=0):
+        with self.send_lock:
+            self.sock.sendall(encode_frame(frame_type, payload, request_id))
+
+    def send_text(self, text, request_id=0):
+        self.send_frame(FRAME_TEXT, text.encode('utf-8'), request_id)
+
+    def send_fields(self, fields, request_id=0):
+        self.send_text(fields_text(fields, self.version), request_id)
+
+    def send_binary(self, data, request_id=0):
+        self.send_frame(FRAME_BINARY, data, request_id)
+
+    def recv_frame(self):
+        while not self.pending:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+
+    def recv_text(self):
+        frame = self.recv_frame()
+        if frame is None:
+            return ""
+        return frame.text()
+
+    def recv_fields(self):
+        frame = self.recv_frame()
+        if frame is None:
+            return None
+        return parse_fields(frame.text(), self.version)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
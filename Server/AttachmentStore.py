@@ -0,0 +1,98 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+class AttachmentStore:
+    def __init__(self, data_dir, index_path):
+        self.objects_dir = os.path.join(data_dir, "objects")
+        if not os.path.exists(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        index_dir = os.path.dirname(index_path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.index_path = index_path
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def path(self, file_hash):
+        if not HASH_PATTERN.match(file_hash):
+            raise ValueError(f"Invalid attachment hash: {file_hash}")
+        return os.path.join(self.objects_dir, file_hash[:2], file_hash)
+
+    def exists(self, file_hash):
+        return HASH_PATTERN.match(file_hash) is not None and os.path.exists(self.path(file_hash))
+
+    def add_reference(self, file_hash):
+        # Called when a message points at an attachment that is already stored.
+        updated = self.connection().execute("UPDATE attachments SET refs = refs + 1 WHERE hash = ?", (file_hash,)).rowcount
+        return updated == 1
+
+    def store_file(self, source_path, file_hash):
+        # Moves an uploaded file into the store, or drops it if the same
+        # content is already there, and counts one more reference.
+        path = self.path(file_hash)
+        if os.path.exists(path):
+            os.remove(source_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source_path, path)
+        self.connection().execute(
+            "INSERT INTO attachments (hash, size, refs) VALUES (?, ?, 1) "
+            "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1", (file_hash, os.path.getsize(path)))
+        return path
+
+    def store_bytes(self, data):
+        file_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(file_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + ".tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        self.connection().execute(
+            "INSERT INTO attachments (hash, size, refs) VALUES (?, ?, 1) "
+            "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1", (file_hash, len(data)))
+        return file_hash
+
+    def release(self, file_hash):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE attachments SET refs = refs - 1 WHERE hash = ?", (file_hash,))
+            row = connection.execute("SELECT refs FROM attachments WHERE hash = ?", (file_hash,)).fetchone()
+            if row is not None and row[0] <= 0:
+                connection.execute("DELETE FROM attachments WHERE hash = ?", (file_hash,))
+                if os.path.exists(self.path(file_hash)):
+                    os.remove(self.path(file_hash))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,487 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import (CHUNK_SIZE, FRAME_BINARY, HELLO_SIZE, FrameDecoder, ProtocolError, encode_chunk, encode_frame,
+                      encode_text, fields_text, hello, join_fields, parse_fields, parse_hello)
+
+# Headless load test: starts a ChatServer on SQLite in a temporary directory
+# in its own process and drives it with simulated clients speaking the framed
+# protocol, then reports latency per command and the server's CPU and memory.
+
+BENCHMARK_HOST = "::1"
+BENCHMARK_PORT = 9900
+DEFAULT_MIX = "send_message=50,list_friends=15,subscribe=15,get_messages=10,find_user=8,upload=2"
+REQUEST_TIMEOUT = 10
+# Clients connecting at the same time during setup.
+CONNECT_CONCURRENCY = 50
+# How long to wait after the run for messages still being delivered.
+DELIVERY_GRACE = 2.0
+PERCENTILES = (50, 95, 99)
+
+def memory_usage():
+    # Resident set size in bytes, or the peak when only that is available.
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def raise_file_limit():
+    # Every simulated client is a socket on both sides.
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def run_server(control, host, port, data_dir, durable_ack, flush_interval):
+    # Runs in the server process. ChatServer keeps its files relative to the
+    # working directory, so it is only imported once we are in data_dir.
+    raise_file_limit()
+    os.chdir(data_dir)
+    from Storage import get_storage
+    from ChatServer import ChatServer
+    storage = get_storage("sqlite", path=os.path.join(data_dir, "benchmark.db"))
+    server = ChatServer(host, port, storage=storage, durable_ack=durable_ack, flush_interval=flush_interval,
+                        log=lambda message: None)
+    try:
+        server.start_in_thread()
+    except Exception as e:
+        control.send(("error", str(e)))
+        return
+    control.send(("ready", None))
+    while True:
+        command = control.recv()
+        if command == "stats":
+            control.send(("stats", {
+                "cpu_seconds": time.process_time(),
+                "rss_bytes": memory_usage(),
+                "connections": len(server.client_sockets)
+            }))
+        elif command == "stop":
+            server.stop()
+            control.send(("stopped", None))
+            return
+
+class ServerProcess:
+    def __init__(self, host, port, durable_ack=True, flush_interval=0.05):
+        self.host = host
+        self.port = port
+        self.data_dir = tempfile.mkdtemp(prefix="pychat-benchmark-")
+        self.control, child_control = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_server, args=(child_control, host, port, self.data_dir, durable_ack, flush_interval),
+            name="benchmark-server", daemon=True)
+
+    def start(self):
+        self.process.start()
+        status, error = self.control.recv()
+        if status != "ready":
+            self.stop()
+            raise RuntimeError(f"Server did not start: {error}")
+
+    def stats(self):
+        self.control.send("stats")
+        return self.control.recv()[1]
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                self.control.send("stop")
+                if self.control.poll(10):
+                    self.control.recv()
+            except (OSError, EOFError):
+                pass
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.recording = False
+
+    def add(self, command, seconds):
+        if self.recording:
+            self.latencies[command].append(seconds)
+
+    def error(self, command):
+        if self.recording:
+            self.errors[command] += 1
+
+    def summary(self, duration):
+        commands = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[command])
+            entry = {"count": len(values), "errors": self.errors[command], "per_second": round(len(values) / duration, 2)}
+            if values:
+                entry["mean_ms"] = round(sum(values) / len(values) * 1000, 3)
+                for percent in PERCENTILES:
+                    entry[f"p{percent}_ms"] = round(percentile(values, percent) * 1000, 3)
+                entry["max_ms"] = round(values[-1] * 1000, 3)
+            commands[command] = entry
+        return commands
+
+def percentile(values, percent):
+    # Nearest rank on sorted values.
+    index = max(int(len(values) * percent / 100.0 + 0.999999) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+class BenchmarkClient:
+    def __init__(self, index, recorder):
+        self.index = index
+        self.username = f"bench{index}"
+        self.recorder = recorder
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self.request_ids = 0
+        self.read_task = None
+        self.last_order = 0
+        self.sent_messages = 0
+        self.version = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(hello())
+        self.version = parse_hello(await self.reader.readexactly(HELLO_SIZE))
+        if self.version is None:
+            raise ProtocolError("Server does not support the framed protocol")
+        self.read_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    future = self.pending.pop(frame.request_id, None) if frame.request_id else None
+                    if future is not None:
+                        if not future.done():
+                            future.set_result(self.text_of(frame))
+                    else:
+                        self.handle_push(self.text_of(frame))
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the server was lost"))
+
+    def encode(self, text, request_id=0):
+        # Commands are written "|"-joined here and sent as fields; replies are
+        # joined back the same way, as the scripts only read their prefixes
+        # and orders.
+        return encode_text(fields_text(text.split("|"), self.version), request_id)
+
+    def text_of(self, frame):
+        return join_fields(parse_fields(frame.text(), self.version))
+
+    def handle_push(self, text):
+        # Messages carry the time they were sent, so their latency is measured
+        # from send to delivery at the receiver.
+        parts = text.split("|")
+        if parts[0] == "new_message" and len(parts) > 3:
+            if parts[1] == self.username:
+                # Our own message, echoed with its order.
+                return
+            message = parts[3]
+        elif parts[0] == "received_message" and len(parts) > 2:
+            message = parts[2]
+        else:
+            return
+        if message.startswith("bench:"):
+            self.recorder.add("send_message", (time.perf_counter_ns() - int(message[6:])) / 1e9)
+
+    def expect(self, request_id):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        return future
+
+    def next_request_id(self):
+        self.request_ids += 1
+        return self.request_ids
+
+    async def request(self, text, request_id=None):
+        request_id = request_id or self.next_request_id()
+        future = self.expect(request_id)
+        self.writer.write(self.encode(text, request_id))
+        await self.writer.drain()
+        return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+
+    async def register(self):
+        response = await self.request(f"register|Bench {self.index}|{self.username}|benchmark|09{self.index:08d}")
+        if response != "register_success":
+            raise ValueError(response)
+
+    async def login(self):
+        response = await self.request(f"login|{self.username}|benchmark")
+        if not response.startswith("login_success"):
+            raise ValueError(response)
+
+    async def add_friend(self, friend):
+        await self.request(f"add_friend|{self.username}|{friend}")
+
+    async def list_friends(self, friend):
+        await self.request(f"list_friends|{self.username}")
+
+    async def find_user(self, friend):
+        await self.request(f"find_user|{friend[:4]}")
+
+    async def get_messages(self, friend):
+        # What clients without a cache poll: the whole history. Unlike
+        # subscribe it does not move the connection's subscription.
+        response = await self.request(f"get_messages|{self.username}|{friend}")
+        if response.startswith("messages_error"):
+            raise ValueError(response)
+
+    async def subscribe(self, friend):
+        # What clients with a cache do: sync what came after the last order.
+        response = await self.request(f"subscribe|{self.username}|{friend}|{self.last_order}|500")
+        if not response.startswith("sync|"):
+            raise ValueError(response)
+        for item in response.split("|", 3)[-1].split(";"):
+            order = item.split("|", 1)[0]
+            if order.isdigit():
+                self.last_order = max(self.last_order, int(order))
+
+    async def send_message(self, friend):
+        # No reply for framed clients; latency is recorded on delivery.
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.writer.write(self.encode(f"send_message|{self.username}|{friend}|bench:{time.perf_counter_ns()}|text|{timestamp}"))
+        await self.writer.drain()
+        if self.recorder.recording:
+            self.sent_messages += 1
+
+    async def upload(self, friend, size):
+        data = os.urandom(size)
+        upload_id = secrets.token_hex(16)
+        request_id = self.next_request_id()
+        response = await self.request(f"upload_begin|{self.username}|{friend}|bench.bin|{size}|{upload_id}", request_id)
+        if not response.startswith("upload_offset"):
+            raise ValueError(response)
+        # The server answers upload_end with the request id of upload_begin.
+        done = self.expect(request_id)
+        view = memoryview(data)
+        for offset in range(0, size, CHUNK_SIZE):
+            self.writer.write(encode_frame(FRAME_BINARY, encode_chunk(offset, view[offset:offset + CHUNK_SIZE])))
+            await self.writer.drain()
+        self.writer.write(self.encode(f"upload_end|{upload_id}", request_id))
+        await self.writer.drain()
+        response = await asyncio.wait_for(done, REQUEST_TIMEOUT)
+        if not response.startswith("upload_done"):
+            raise ValueError(response)
+
+    async def run_script(self, friend, mix, stop_time, think_time, upload_size):
+        commands, weights = zip(*mix.items())
+        while time.monotonic() < stop_time:
+            command = random.choices(commands, weights)[0]
+            start = time.perf_counter()
+            try:
+                if command == "upload":
+                    await self.upload(friend, upload_size)
+                else:
+                    await getattr(self, command)(friend)
+            except (asyncio.TimeoutError, ConnectionError, ProtocolError, ValueError):
+                self.recorder.error(command)
+                if self.writer.is_closing():
+                    return
+            else:
+                if command != "send_message":
+                    self.recorder.add(command, time.perf_counter() - start)
+            if think_time > 0:
+                await asyncio.sleep(random.expovariate(1.0 / think_time))
+
+    def close(self):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        command = command.strip()
+        if command not in ("send_message", "list_friends", "subscribe", "get_messages", "find_user", "upload"):
+            raise ValueError(f"Unknown command in mix: {command}")
+        mix[command] = float(weight or 1)
+    return mix
+
+async def setup_clients(args, recorder):
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    clients = [BenchmarkClient(index, recorder) for index in range(args.clients)]
+
+    async def setup(client):
+        async with semaphore:
+            await client.connect(args.host, args.port)
+            for command in ("register", "login"):
+                start = time.perf_counter()
+                await getattr(client, command)()
+                recorder.add(command, time.perf_counter() - start)
+
+    await asyncio.gather(*(setup(client) for client in clients))
+    # Each client talks to the next one, so every client also receives.
+    await asyncio.gather(*(client.add_friend(friend_of(clients, client).username) for client in clients))
+    return clients
+
+def friend_of(clients, client):
+    return clients[(client.index + 1) % len(clients)]
+
+async def drive(args, server):
+    recorder = Recorder()
+    recorder.recording = True
+    idle = server.stats()
+    setup_start = time.monotonic()
+    clients = await setup_clients(args, recorder)
+    setup = recorder.summary(time.monotonic() - setup_start)
+    connected = server.stats()
+    print(f"{len(clients)} clients connected, running for {args.duration} seconds", file=sys.stderr)
+
+    recorder.latencies.clear()
+    recorder.errors.clear()
+    mix = parse_mix(args.mix)
+    start = time.monotonic()
+    stop_time = start + args.duration
+    await asyncio.gather(*(client.run_script(friend_of(clients, client).username, mix, stop_time,
+                                             args.think_time, args.upload_size) for client in clients))
+    duration = time.monotonic() - start
+    finished = server.stats()
+    await asyncio.sleep(DELIVERY_GRACE)
+    recorder.recording = False
+    for client in clients:
+        client.close()
+
+    commands = recorder.summary(duration)
+    sent = sum(client.sent_messages for client in clients)
+    if "send_message" in commands:
+        commands["send_message"]["sent"] = sent
+        commands["send_message"]["per_second"] = round(sent / duration, 2)
+    completed = sum(entry["count"] for name, entry in commands.items() if name != "send_message") + sent
+    cpu_seconds = finished["cpu_seconds"] - connected["cpu_seconds"]
+    server_result = {
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_utilisation": round(cpu_seconds / duration, 3),
+        "cpu_ms_per_connection": round(cpu_seconds / len(clients) * 1000, 3),
+        "cpu_us_per_operation": round(cpu_seconds / completed * 1e6, 3) if completed else None,
+        "connections": connected["connections"],
+        "rss_idle_bytes": idle["rss_bytes"],
+        "rss_connected_bytes": connected["rss_bytes"],
+        "rss_end_bytes": finished["rss_bytes"],
+        "memory_per_connection_bytes": None
+    }
+    if idle["rss_bytes"] is not None and connected["rss_bytes"] is not None:
+        server_result["memory_per_connection_bytes"] = (connected["rss_bytes"] - idle["rss_bytes"]) // len(clients)
+    return {
+        "config": {
+            "clients": args.clients,
+            "duration": args.duration,
+            "think_time": args.think_time,
+            "mix": mix,
+            "upload_size": args.upload_size,
+            "durable_ack": not args.no_durable_ack,
+            "flush_interval": args.flush_interval
+        },
+        "duration": round(duration, 3),
+        "throughput": round(completed / duration, 2),
+        "operations": completed,
+        "commands": commands,
+        "setup": setup,
+        "server": server_result
+    }
+
+def run_benchmark(args):
+    raise_file_limit()
+    server = ServerProcess(args.host, args.port, not args.no_durable_ack, args.flush_interval)
+    server.start()
+    try:
+        return asyncio.run(drive(args, server))
+    finally:
+        server.stop()
+
+def compare_results(baseline, result, tolerance):
+    # Lists what got worse than the baseline by more than tolerance.
+    regressions = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']} -> {result['throughput']}")
+    for command, entry in result["commands"].items():
+        old = baseline["commands"].get(command)
+        if old is None:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if key in entry and key in old and entry[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{command} {key} {old[key]} -> {entry[key]}")
+    old_cpu, cpu = baseline["server"].get("cpu_us_per_operation"), result["server"].get("cpu_us_per_operation")
+    if old_cpu and cpu and cpu > old_cpu * (1 + tolerance):
+        regressions.append(f"cpu_us_per_operation {old_cpu} -> {cpu}")
+    return regressions
+
+def print_summary(result):
+    print(f"{result['operations']} operations in {result['duration']} s, {result['throughput']} per second")
+    for command, entry in result["commands"].items():
+        latency = " ".join(f"p{percent}={entry[f'p{percent}_ms']}ms" for percent in PERCENTILES if f"p{percent}_ms" in entry)
+        print(f"  {command:<13} {entry['count']:>8} ok {entry['errors']:>5} errors  {latency}")
+    server = result["server"]
+    print(f"  server cpu {server['cpu_utilisation']:.0%}, {server['cpu_us_per_operation']} us/op, "
+          f"{server['memory_per_connection_bytes']} bytes/connection")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat server with simulated clients.")
+    parser.add_argument("--clients", type=int, default=50, help="number of simulated clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the scripts for")
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean pause between a client's commands")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="command weights, e.g. send_message=50,upload=2")
+    parser.add_argument("--upload-size", type=int, default=256 * 1024, help="bytes per uploaded file")
+    parser.add_argument("--host", default=BENCHMARK_HOST)
+    parser.add_argument("--port", type=int, default=BENCHMARK_PORT, help="chat port; the media relay uses the next one")
+    parser.add_argument("--flush-interval", type=float, default=0.05, help="message batch interval of the server")
+    parser.add_argument("--no-durable-ack", action="store_true", help="deliver messages before they are committed")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    parser.add_argument("--compare", help="JSON result of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against --compare")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+        print_summary(result)
+    else:
+        print(json.dumps(result, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_results(json.load(baseline_file), result, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
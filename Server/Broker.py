@@ -0,0 +1,268 @@
+import asyncio
+import json
+import os
+import sys
+from Sessions import SessionManager
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import FrameDecoder, ProtocolError, encode_text
+from MediaRelay import MediaRelay
+
+# When the server runs as several worker processes, each worker only knows its
+# own connections. The broker is the one place that knows which worker each
+# user is on, numbers messages, holds the login sessions and runs the media
+# relay. Workers talk to it over a UNIX socket with the framed protocol: pushes
+# have request id 0, and requests get a JSON encoded reply with their id.
+#
+#   online|user, offline|user     presence, broadcast as online|user|worker
+#   route|user|json               forwarded as deliver|user|json to user's worker
+#   message|json, user|json       saved messages and new users, broadcast
+#   discard|conversation          drop a cached conversation, broadcast
+#   allocate|conversation[|seed]  next order, or null until seeded from storage
+#   allocated|conversation        last order handed out, or null
+#   sessions|method|args...       SessionManager calls
+#   relay|method|args...          MediaRelay calls
+
+SESSION_METHODS = ("create", "resolve", "revoke")
+RELAY_METHODS = ("create_call", "invite", "join_token", "decline", "is_member")
+BROADCASTS = ("message", "user", "discard")
+
+class WorkerLink:
+    def __init__(self, worker_id, writer):
+        self.worker_id = worker_id
+        self.writer = writer
+
+    def send(self, text, request_id=0):
+        if not self.writer.is_closing():
+            self.writer.write(encode_text(text, request_id))
+
+class Broker:
+    def __init__(self, path, media_host=None, media_port=None, log=print):
+        self.path = path
+        self.media_host = media_host
+        self.media_port = media_port
+        self.log = log
+        self.workers = {}
+        self.presence = {}
+        self.last_orders = {}
+        self.sessions = SessionManager()
+        self.relay = MediaRelay(log=log)
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_worker, self.path)
+        self.log(f"Broker listening on {self.path}")
+        if self.media_port is not None:
+            await self.relay.start(self.media_host, self.media_port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.relay.close()
+        for link in list(self.workers.values()):
+            link.writer.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def broadcast(self, text, source=None):
+        for link in self.workers.values():
+            if link is not source:
+                link.send(text)
+
+    async def handle_worker(self, reader, writer):
+        decoder = FrameDecoder()
+        link = None
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    text = frame.text()
+                    if link is None:
+                        kind, _, worker_id = text.partition("|")
+                        if kind != "hello":
+                            raise ProtocolError(f"Expected hello from worker, got {text}")
+                        link = self.add_worker(worker_id, writer)
+                        continue
+                    self.handle_frame(link, text, frame.request_id)
+                await writer.drain()
+        except (ConnectionError, ProtocolError) as e:
+            self.log(f"Broker connection error: {str(e)}")
+        finally:
+            if link is not None:
+                self.remove_worker(link)
+            writer.close()
+
+    def add_worker(self, worker_id, writer):
+        if worker_id in self.workers:
+            self.remove_worker(self.workers[worker_id])
+        link = WorkerLink(worker_id, writer)
+        self.workers[worker_id] = link
+        # A worker that (re)starts late still needs to know who is where.
+        for username, user_worker in self.presence.items():
+            link.send(f"online|{username}|{user_worker}")
+        self.log(f"Worker {worker_id} connected to the broker")
+        return link
+
+    def remove_worker(self, link):
+        if self.workers.get(link.worker_id) is not link:
+            return
+        del self.workers[link.worker_id]
+        for username, worker_id in list(self.presence.items()):
+            if worker_id == link.worker_id:
+                del self.presence[username]
+                self.broadcast(f"offline|{username}|{worker_id}")
+        self.log(f"Worker {link.worker_id} disconnected from the broker")
+
+    def handle_frame(self, link, text, request_id):
+        kind, _, rest = text.partition("|")
+        if kind == "online":
+            self.presence[rest] = link.worker_id
+            self.broadcast(f"online|{rest}|{link.worker_id}", link)
+        elif kind == "offline":
+            if self.presence.get(rest) == link.worker_id:
+                del self.presence[rest]
+                self.broadcast(f"offline|{rest}|{link.worker_id}", link)
+        elif kind == "route":
+            username = rest.partition("|")[0]
+            target = self.workers.get(self.presence.get(username))
+            if target is not None:
+                target.send(f"deliver|{rest}")
+        elif kind in BROADCASTS:
+            self.broadcast(text, link)
+        elif request_id:
+            link.send(json.dumps(self.handle_request(kind, rest.split("|") if rest else [])), request_id)
+
+    def handle_request(self, kind, args):
+        if kind == "allocate":
+            conversation_id = args[0]
+            if conversation_id not in self.last_orders:
+                if len(args) < 2:
+                    return None
+                self.last_orders[conversation_id] = int(args[1])
+            self.last_orders[conversation_id] += 1
+            return self.last_orders[conversation_id]
+        if kind == "allocated":
+            return self.last_orders.get(args[0])
+        if kind == "sessions" and args and args[0] in SESSION_METHODS:
+            return getattr(self.sessions, args[0])(*args[1:])
+        if kind == "relay" and args and args[0] in RELAY_METHODS:
+            return getattr(self.relay, args[0])(*args[1:])
+        self.log(f"Unknown broker request: {kind}")
+        return None
+
+class BrokerClient:
+    # A worker's link to the broker; runs on the worker's event loop.
+    def __init__(self, path, worker_id, log=print):
+        self.path = path
+        self.worker_id = str(worker_id)
+        self.log = log
+        self.presence = {}
+        self.pending = {}
+        self.request_ids = 0
+        self.chat_server = None
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.closing = False
+
+    async def connect(self, chat_server):
+        self.chat_server = chat_server
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.send(f"hello|{self.worker_id}")
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    def close(self):
+        self.closing = True
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+
+    def send(self, text, request_id=0):
+        self.writer.write(encode_text(text, request_id))
+
+    async def request(self, text):
+        self.request_ids += 1
+        request_id = self.request_ids
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.send(text, request_id)
+        return json.loads(await future)
+
+    async def call(self, target, method, *args):
+        return await self.request("|".join((target, method) + args))
+
+    def is_online(self, username):
+        return username in self.presence
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    future = self.pending.pop(frame.request_id, None) if frame.request_id else None
+                    if future is not None:
+                        if not future.done():
+                            future.set_result(frame.text())
+                    else:
+                        self.handle_push(frame.text())
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to the broker"))
+            self.pending.clear()
+        # Without the broker this worker cannot reach users on the others, so
+        # it stops and leaves restarting to the supervisor.
+        if not self.closing:
+            self.log(f"Worker {self.worker_id} lost its broker, stopping")
+            self.chat_server.server.close()
+
+    def handle_push(self, text):
+        kind, _, rest = text.partition("|")
+        if kind == "online":
+            username, _, worker_id = rest.rpartition("|")
+            self.presence[username] = worker_id
+        elif kind == "offline":
+            username, _, worker_id = rest.rpartition("|")
+            if self.presence.get(username) == worker_id:
+                del self.presence[username]
+        elif kind == "deliver":
+            username, _, message = rest.partition("|")
+            self.chat_server.send_to(username, json.loads(message), route=False)
+        elif kind == "message":
+            self.chat_server.remote_message_saved(json.loads(rest))
+        elif kind == "user":
+            self.chat_server.directory.add(json.loads(rest))
+        elif kind == "discard":
+            self.chat_server.cache.discard(rest)
+
+class BrokerSequenceAllocator:
+    # Stands in for MessageWriter's SequenceAllocator so orders stay unique
+    # when several workers write to the same conversation.
+    def __init__(self, broker, storage, run_storage):
+        self.broker = broker
+        self.storage = storage
+        self.run_storage = run_storage
+
+    async def allocate(self, conversation_id, sender, receiver):
+        order = await self.broker.request(f"allocate|{conversation_id}")
+        if order is None:
+            last_order = await self.run_storage(self.storage.get_last_order, sender, receiver)
+            order = await self.broker.request(f"allocate|{conversation_id}|{last_order}")
+        return order
+
+    async def is_settled(self, conversation_id, messages):
+        # Other workers save their own batches, so a message can be missing
+        # from the middle of a tail as well as from its end.
+        last_order = messages[-1]["order"] if messages else 0
+        allocated = await self.broker.request(f"allocated|{conversation_id}")
+        if allocated is not None and allocated != last_order:
+            return False
+        return all(later["order"] == earlier["order"] + 1 for earlier, later in zip(messages, messages[1:]))
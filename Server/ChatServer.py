@@ -0,0 +1,833 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Storage import SERVER_STATE_DIR, get_storage, move_database
+from MessageWriter import MessageWriter
+from ConversationCache import ConversationCache
+from UserDirectory import UserDirectory
+from FileTransfer import UploadStore, open_download, write_chunk
+from AttachmentStore import AttachmentStore, hash_file
+from Sessions import SessionManager
+from Metrics import InstrumentedStorage, Metrics, MetricsServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Protocol import (DOWNLOAD_FRAME_SIZE, FIELDS_VERSION, FRAME_BINARY, FRAME_TEXT, HEADER, HELLO_SIZE,
+                      PROTOCOL_VERSION, FrameDecoder, ProtocolError, decode_chunk, encode_text, fields_text, hello,
+                      is_hello_prefix, join_fields, parse_fields, parse_hello)
+from MediaRelay import MediaRelay
+from Broker import BrokerSequenceAllocator
+
+SERVER_DATA_DIR = "ServerData"
+# The Prometheus endpoint and the stats command are only for this machine.
+METRICS_HOST = "localhost"
+ADMIN_ADDRESSES = ("::1", "127.0.0.1", "::ffff:127.0.0.1")
+HISTORY_PAGE_SIZE = 50
+# Framed clients must log in (or resume) before any other command.
+ANONYMOUS_COMMANDS = ("login", "resume", "register", "logout", "stats")
+# Commands whose first argument names the user doing it; for an identified
+# connection that is always the connection's own user.
+USER_COMMANDS = ("add_friend", "list_friends", "send_message", "get_messages", "get_messages_page", "subscribe",
+                 "unsubscribe", "call_video_request", "call_video_response", "send_file", "upload_begin",
+                 "download_file")
+MAX_PAGE_SIZE = 500
+
+if not os.path.exists(SERVER_DATA_DIR):
+    os.makedirs(SERVER_DATA_DIR)
+
+class ClientConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.username = None
+        self.subscription = None
+        # Request id of the message being handled; replies echo it so the
+        # client can match them to its requests.
+        self.request_id = 0
+        self.framed = False
+        # Protocol version of a framed connection; see Protocol.FIELDS_VERSION.
+        self.version = 0
+        self.decoder = None
+        self.pending = deque()
+        self.first_message = None
+
+    async def negotiate(self):
+        data = await self.reader.read(65536)
+        while data and len(data) < HELLO_SIZE and is_hello_prefix(data):
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                break
+            data += chunk
+        version = parse_hello(data)
+        if version is None:
+            # Legacy client: the first read is already its first message.
+            self.first_message = data
+            return
+        self.framed = True
+        self.version = min(version, PROTOCOL_VERSION)
+        self.decoder = FrameDecoder()
+        self.writer.write(hello(self.version))
+        self.pending.extend(self.decoder.feed(data[HELLO_SIZE:]))
+
+    async def read_frame(self):
+        while not self.pending:
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+
+    async def read_message(self):
+        if self.framed:
+            frame = await self.read_frame()
+            if frame is None:
+                return None
+            if frame.frame_type != FRAME_TEXT:
+                raise ProtocolError(f"Expected a text frame, got type {frame.frame_type}")
+            self.request_id = frame.request_id
+            return self.parse(frame.text())
+        if self.first_message is not None:
+            data, self.first_message = self.first_message, None
+        else:
+            data = await self.reader.read(1024)
+        if not data:
+            return None
+        return data.decode('utf-8', errors='replace').split("|")
+
+    def parse(self, text):
+        parts = parse_fields(text, self.version)
+        if not all(isinstance(part, str) for part in parts):
+            raise ProtocolError("Command fields must be strings")
+        return parts
+
+    async def read_data(self, size):
+        if not self.framed:
+            return await self.reader.readexactly(size)
+        frame = await self.read_frame()
+        if frame is None:
+            raise asyncio.IncompleteReadError(b"", size)
+        if frame.frame_type != FRAME_BINARY or len(frame.payload) != size:
+            raise ProtocolError(f"Expected {size} bytes of binary data")
+        return frame.payload
+
+    def send(self, message, request_id=0):
+        # message is a list of fields, or "|"-joined text for messages whose
+        # fields never hold "|".
+        if isinstance(message, str):
+            if not self.framed or self.version < FIELDS_VERSION:
+                text = message
+            else:
+                text = fields_text(message.split("|"), self.version)
+        else:
+            text = fields_text(message, self.version) if self.framed else join_fields(message)
+        if self.framed:
+            self.writer.write(encode_text(text, request_id))
+        else:
+            self.writer.write(text.encode('utf-8'))
+
+    def reply(self, message):
+        self.send(message, self.request_id)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+class ChatServer:
+    def __init__(self, host, port, storage=None, max_workers=8, max_pending=64, flush_interval=0.05,
+                 durable_ack=True, cache=None, media_port=None, metrics_port=None, log=print,
+                 on_event=None, broker=None, reuse_port=False, legacy_identify=True):
+        self.host = host
+        self.port = port
+        # Call video goes through the media relay on its own port.
+        self.media_port = media_port if media_port is not None else port + 1
+        self.metrics_port = metrics_port if metrics_port is not None else port + 2
+        self.log = log
+        # on_event(event, username) hears about user_registered, user_online
+        # and user_offline; it is called on the server's event loop.
+        self.on_event = on_event or (lambda event, username: None)
+        # As one of several workers (see Broker.py) users, message orders,
+        # sessions and calls are shared through the broker, and the listening
+        # port is shared with SO_REUSEPORT.
+        self.broker = broker
+        self.reuse_port = reuse_port
+        # Legacy clients identify by sending their bare username, with no
+        # password; turn this off once every client logs in.
+        self.legacy_identify = legacy_identify
+        self.metrics = Metrics()
+        self.command_seconds = self.metrics.histogram("command_seconds", "Time spent handling each command.", "command")
+        self.command_errors = self.metrics.counter("command_errors_total", "Commands that raised an error.", "command")
+        self.storage = InstrumentedStorage(
+            storage if storage is not None else get_storage(),
+            self.metrics.histogram("storage_seconds", "Time spent in each storage call.", "method"),
+            self.metrics.counter("storage_errors_total", "Storage calls that raised an error.", "method"))
+        # Storage calls are blocking, so they run on a small fixed pool and the
+        # number of calls waiting for a worker is capped by storage_slots.
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.storage_slots = None
+        # Messages are numbered in memory and written in batches. With
+        # durable_ack a message is only delivered once its batch is committed.
+        self.flush_interval = flush_interval
+        self.durable_ack = durable_ack
+        self.writer = None
+        self.cache = cache if cache is not None else ConversationCache()
+        self.directory = UserDirectory()
+        self.uploads = UploadStore(SERVER_DATA_DIR)
+        attachment_index = os.path.join(SERVER_STATE_DIR, "attachments.db")
+        move_database(os.path.join(SERVER_DATA_DIR, "attachments.db"), attachment_index)
+        self.attachments = AttachmentStore(SERVER_DATA_DIR, attachment_index)
+        self.relay = MediaRelay(log=log)
+        self.sessions = SessionManager()
+        self.client_sockets = {}
+        # Every open connection, identified or not (transfers, before login).
+        self.connections = set()
+        self.metrics.gauge("connections", "Identified client connections.", lambda: len(self.client_sockets))
+        self.metrics.gauge("sessions", "Login sessions that can be resumed.", lambda: len(self.sessions.sessions))
+        self.metrics.gauge("pending_writes", "Messages waiting for their batch to be saved.",
+                           lambda: len(self.writer.pending) if self.writer else 0)
+        self.metrics.gauge("cache", "Conversation cache statistics.", self.cache.stats, label="stat")
+        self.metrics.gauge("relay", "Media relay statistics.", self.relay.stats, label="stat")
+        self.metrics_server = MetricsServer(self.metrics, log=log)
+        self.server = None
+        self.loop = None
+        self.thread = None
+        self.handlers = {
+            "login": self.handle_login,
+            "resume": self.handle_resume,
+            "logout": self.handle_logout,
+            "register": self.handle_register,
+            "add_friend": self.handle_add_friend,
+            "list_friends": self.handle_list_friends,
+            "find_user": self.handle_find_user,
+            "send_message": self.handle_send_message,
+            "get_messages": self.handle_get_messages,
+            "get_messages_page": self.handle_get_messages_page,
+            "subscribe": self.handle_subscribe,
+            "unsubscribe": self.handle_unsubscribe,
+            "call_video_request": self.handle_video_call_request,
+            "call_video_response": self.handle_video_call_response,
+            "send_file": self.handle_file_transfer,
+            "upload_begin": self.handle_upload,
+            "download_file": self.handle_download,
+            "stats": self.handle_stats,
+        }
+
+    async def run_storage(self, func, *args):
+        async with self.storage_slots:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def run_file_io(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="storage")
+        self.storage_slots = asyncio.Semaphore(self.max_workers + self.max_pending)
+        allocator = None
+        if self.broker is not None:
+            await self.broker.connect(self)
+            allocator = BrokerSequenceAllocator(self.broker, self.storage, self.run_storage)
+        self.writer = MessageWriter(self.storage, self.run_storage, self.flush_interval, allocator=allocator, log=self.log)
+        self.writer.start()
+        await self.load_directory()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=1024,
+                                                 reuse_port=self.reuse_port or None)
+        self.log(f"Server started on port: {self.port}")
+        if self.broker is None:
+            await self.relay.start(self.host, self.media_port)
+        await self.metrics_server.start(METRICS_HOST, self.metrics_port)
+
+    async def serve(self, ready=None):
+        await self.start()
+        if ready is not None:
+            ready.set()
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            # Leaving the block waits for the server to close, which on newer
+            # Pythons includes every live connection, so close them first.
+            for connection in list(self.connections):
+                connection.close()
+        self.relay.close()
+        self.metrics_server.close()
+        if self.broker is not None:
+            self.broker.close()
+        self.client_sockets.clear()
+        await self.writer.stop()
+        self.executor.shutdown(wait=False)
+        self.log(f"Server on port {self.port} stopped")
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def start_in_thread(self):
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                asyncio.run(self.serve(ready))
+            except Exception as e:
+                errors.append(e)
+                ready.set()
+
+        self.thread = threading.Thread(target=run, name="chat-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    async def user_list(self):
+        # Run on the event loop, which owns the directory; None until loaded.
+        return self.directory.usernames() if self.directory.loaded else None
+
+    async def load_directory(self):
+        try:
+            users = await self.run_storage(self.storage.get_users)
+        except Exception as e:
+            self.log(f"Error loading user directory: {str(e)}")
+            return
+        self.directory.load(users)
+        self.log(f"Loaded {len(self.directory.users)} users into the directory")
+
+    async def handle_connection(self, reader, writer):
+        connection = ClientConnection(reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.negotiate()
+            while True:
+                parts = await connection.read_message()
+                if parts is None:
+                    break
+                handler = self.handlers.get(parts[0])
+                anonymous = connection.framed and connection.username is None
+                if handler is not None and anonymous and parts[0] not in ANONYMOUS_COMMANDS:
+                    connection.reply(f"auth_required|{parts[0]}")
+                    await connection.drain()
+                elif handler is not None:
+                    if connection.username is not None and parts[0] in USER_COMMANDS and len(parts) > 1:
+                        parts[1] = connection.username
+                    start = time.perf_counter()
+                    try:
+                        keep_open = await handler(connection, parts)
+                    except Exception:
+                        self.command_errors.increment(parts[0])
+                        raise
+                    finally:
+                        self.command_seconds.observe(parts[0], time.perf_counter() - start)
+                    await connection.drain()
+                    if keep_open is False:
+                        break
+                elif connection.username is None and len(parts) == 1:
+                    if connection.framed or not self.legacy_identify:
+                        # Framed clients identify with login or resume.
+                        self.log(f"Ignoring unauthenticated identification from {connection.address}")
+                    else:
+                        self.identify(connection, parts[0])
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except ProtocolError as e:
+            self.log(f"Protocol error from {connection.address}: {str(e)}")
+        except Exception as e:
+            self.log(f"Error handling client: {str(e)}")
+        finally:
+            self.release(connection)
+            self.connections.discard(connection)
+            connection.close()
+
+    def release(self, connection):
+        # Takes the user's pushes away from a connection that is closing or
+        # now acts as someone else.
+        if connection.username and self.client_sockets.get(connection.username) is connection:
+            del self.client_sockets[connection.username]
+            if self.broker is not None:
+                self.broker.send(f"offline|{connection.username}")
+            self.on_event("user_offline", connection.username)
+
+    def identify(self, connection, username):
+        if connection.username != username:
+            self.release(connection)
+            connection.subscription = None
+        connection.username = username
+        self.client_sockets[username] = connection
+        self.log(f"Accepted connection from {connection.address} with username {username}")
+        if self.broker is not None:
+            self.broker.send(f"online|{username}")
+        self.on_event("user_online", username)
+
+    def is_online(self, username):
+        return username in self.client_sockets or (self.broker is not None and self.broker.is_online(username))
+
+    def send_to(self, username, message, route=True):
+        connection = self.client_sockets.get(username)
+        if connection is None:
+            if route and self.broker is not None and self.broker.is_online(username):
+                self.broker.send(f"route|{username}|{json.dumps(message)}")
+                return True
+            return False
+        connection.send(message)
+        return True
+
+    async def call_sessions(self, method, *args):
+        if self.broker is not None:
+            return await self.broker.call("sessions", method, *args)
+        return getattr(self.sessions, method)(*args)
+
+    async def call_relay(self, method, *args):
+        if self.broker is not None:
+            return await self.broker.call("relay", method, *args)
+        return getattr(self.relay, method)(*args)
+
+    async def handle_login(self, connection, parts):
+        username, password = parts[1], parts[2]
+        response = await self.run_storage(self.storage.login_user, username, password)
+        if response == "login_success":
+            self.log(f"User {username} logged in.")
+            self.identify(connection, username)
+            if connection.framed:
+                # The client keeps this connection and uses the token to
+                # reconnect without logging in again.
+                connection.reply(f"login_success|{await self.call_sessions('create', username)}")
+            else:
+                connection.reply("login_success")
+        else:
+            connection.reply("Login failed. Please check your credentials.")
+
+    async def handle_resume(self, connection, parts):
+        username = await self.call_sessions("resolve", parts[1]) if len(parts) > 1 else None
+        if username is None:
+            connection.reply("resume_failed")
+            return
+        if len(parts) > 2 and parts[2] == "transfer":
+            # A file transfer connection acts as the user but does not take
+            # the user's pushes away from their chat connection.
+            if connection.username != username:
+                self.release(connection)
+                connection.subscription = None
+            connection.username = username
+        else:
+            self.identify(connection, username)
+        connection.reply(f"resume_success|{username}")
+
+    async def handle_logout(self, connection, parts):
+        if len(parts) > 1:
+            await self.call_sessions("revoke", parts[1])
+        return False
+
+    async def handle_stats(self, connection, parts):
+        if connection.address is None or connection.address[0] not in ADMIN_ADDRESSES:
+            connection.reply("stats_error|Only available on the server machine")
+            return
+        connection.reply(["stats", json.dumps(self.metrics.snapshot())])
+
+    async def handle_register(self, connection, parts):
+        name, username, password, phone = parts[1], parts[2], parts[3], parts[4]
+        response = await self.run_storage(self.storage.register_user, name, username, password, phone)
+        connection.reply(response)
+        if response == "register_success":
+            self.directory.add({"username": username, "name": name, "phone": phone})
+            self.log(f"User {username} registered.")
+            if self.broker is not None:
+                self.broker.send("user|" + json.dumps({"username": username, "name": name, "phone": phone}))
+            self.on_event("user_registered", username)
+        elif not connection.framed:
+            return False
+
+    async def handle_add_friend(self, connection, parts):
+        username, friend_identifier = parts[1], parts[2]
+        if not self.directory.loaded:
+            response = await self.run_storage(self.storage.add_friend, username, friend_identifier)
+        else:
+            friend_username = self.directory.resolve(friend_identifier)
+            if friend_username is None or username not in self.directory:
+                response = "User or friend not found"
+            else:
+                response = await self.run_storage(self.storage.add_friendship, username, friend_username)
+        connection.reply(response)
+
+    async def handle_find_user(self, connection, parts):
+        prefix = parts[1] if len(parts) > 1 else ""
+        users = self.directory.search(prefix) if prefix else []
+        connection.reply(["users", users])
+
+    async def handle_list_friends(self, connection, parts):
+        username = parts[1]
+        response = await self.run_storage(self.storage.get_friends_list, username)
+        connection.reply(response)
+
+    async def handle_send_message(self, connection, parts):
+        sender, receiver, message, message_type, timestamp = parts[1], parts[2], parts[3], parts[4], parts[5]
+        try:
+            await self.save_message(sender, receiver, message, message_type, timestamp, connection)
+        except Exception as e:
+            self.log(f"Error sending message: {str(e)}")
+
+    async def save_message(self, sender, receiver, message, message_type, timestamp, connection=None, file_hash=None):
+        record, saved = await self.writer.submit(sender, receiver, message, message_type, timestamp, file_hash)
+        # With durable_ack delivery waits for the batch commit, but the sender's
+        # connection keeps reading so its next messages join the same batch.
+        if self.durable_ack:
+            saved.add_done_callback(lambda saved: self.message_saved(saved, record, connection))
+        else:
+            saved.add_done_callback(lambda saved: self.report_save_failure(saved, record, connection))
+            self.message_saved(None, record, connection)
+        return record
+
+    def message_saved(self, saved, record, connection):
+        if saved is not None:
+            if saved.cancelled():
+                return
+            if saved.exception() is not None:
+                self.report_save_failure(saved, record, connection)
+                return
+        self.cache.append(conversation_id(record["sender"], record["receiver"]), record)
+        self.deliver_message(record)
+        if self.broker is not None:
+            self.broker.send("message|" + json.dumps(record))
+        if connection is not None and not connection.framed and self.is_online(record["receiver"]):
+            if not connection.writer.is_closing():
+                connection.send(["send_message", record['sender'], record['message'], record['message_type'],
+                                 record['timestamp']])
+
+    def remote_message_saved(self, record):
+        # Saved by another worker: keep our cache in step and deliver to the
+        # receiver if they are connected here.
+        self.cache.append(conversation_id(record["sender"], record["receiver"]), record)
+        self.deliver_message(record)
+
+    def report_save_failure(self, saved, record, connection):
+        if saved.cancelled() or saved.exception() is None:
+            return
+        self.log(f"Error saving message: {str(saved.exception())}")
+        if not self.durable_ack:
+            # The message went into the cache before its batch failed, so the
+            # cache no longer matches storage, here or on the other workers.
+            key = conversation_id(record["sender"], record["receiver"])
+            self.cache.discard(key)
+            if self.broker is not None:
+                self.broker.send(f"discard|{key}")
+        if record.get("file_hash"):
+            asyncio.ensure_future(self.release_attachment(record["file_hash"]))
+        if connection is not None and connection.framed and not connection.writer.is_closing():
+            connection.send(["send_message_error", record['receiver'], record['timestamp'], "Message could not be saved"])
+
+    def deliver_message(self, record):
+        sender, receiver = record["sender"], record["receiver"]
+        message, message_type, timestamp = record["message"], record["message_type"], record["timestamp"]
+        new_message = ["new_message", sender, receiver, message, message_type, timestamp, str(record['order']),
+                       record.get('file_hash', '')]
+        # The sender learns the order of its own message too, so its cache
+        # has no gap where the message is.
+        sending_connection = self.client_sockets.get(sender) if sender != receiver else None
+        if (sending_connection is not None and sending_connection.framed
+                and sending_connection.subscription == conversation_id(sender, receiver)):
+            sending_connection.send(new_message)
+        receiving_connection = self.client_sockets.get(receiver)
+        if receiving_connection is None:
+            return
+        if receiving_connection.subscription == conversation_id(sender, receiver):
+            receiving_connection.send(new_message)
+        else:
+            receiving_connection.send(["received_message", sender, message, message_type, timestamp])
+            if not receiving_connection.framed:
+                receiving_connection.send(f"get_messages|{sender}|{receiver}")
+
+    async def fetch_messages(self, connection, sender, receiver, load, *args):
+        # A storage error is reported to the client rather than answered with
+        # an empty history. Returns None after reporting it.
+        try:
+            return await load(sender, receiver, *args)
+        except Exception as e:
+            self.log(f"Error loading messages of {sender} and {receiver}: {str(e)}")
+            connection.reply(["messages_error", sender, receiver, "Could not load messages"])
+            return None
+
+    async def load_all_messages(self, sender, receiver):
+        messages = self.cache.get_all(conversation_id(sender, receiver))
+        if messages is None:
+            messages = await self.run_storage(self.storage.get_messages, sender, receiver)
+        return messages
+
+    async def handle_get_messages(self, connection, parts):
+        sender, receiver = parts[1], parts[2]
+        messages = await self.fetch_messages(connection, sender, receiver, self.load_all_messages)
+        if messages is not None:
+            connection.reply([format_messages(messages)])
+
+    async def handle_get_messages_page(self, connection, parts):
+        sender, receiver = parts[1], parts[2]
+        after_order, before_order = parse_order(parts, 3), parse_order(parts, 4)
+        limit = min(parse_order(parts, 5) or HISTORY_PAGE_SIZE, MAX_PAGE_SIZE)
+        messages = await self.fetch_messages(connection, sender, receiver, self.load_messages_page,
+                                             after_order, before_order, limit)
+        if messages is not None:
+            connection.reply(["page", format_messages(messages, with_order=True)])
+
+    async def handle_subscribe(self, connection, parts):
+        sender, receiver = parts[1], parts[2]
+        after_order = parse_order(parts, 3)
+        # Subscribe before reading history so nothing saved in between is lost;
+        # the client rebuilds from the history reply and then applies pushes.
+        connection.subscription = conversation_id(sender, receiver)
+        limit = min(parse_order(parts, 4) or HISTORY_PAGE_SIZE, MAX_PAGE_SIZE)
+        if len(parts) > 3 and parts[3] == "latest":
+            # Clients with an empty cache start from the newest page, with
+            # orders, and fetch older pages as they need them.
+            messages = await self.fetch_messages(connection, sender, receiver, self.load_messages_page, None, None, limit)
+            if messages is not None:
+                connection.reply(["latest", sender, receiver, format_messages(messages, with_order=True)])
+            return
+        if after_order is None:
+            messages = await self.fetch_messages(connection, sender, receiver, self.load_messages_page,
+                                                 None, None, HISTORY_PAGE_SIZE)
+            if messages is not None:
+                connection.reply(["history", format_messages(messages)])
+            return
+        # Clients with a local cache pass the last order they have and get the
+        # messages after it, with their orders, to keep syncing from.
+        messages = await self.fetch_messages(connection, sender, receiver, self.load_messages_page, after_order, None, limit)
+        if messages is not None:
+            connection.reply(["sync", sender, receiver, format_messages(messages, with_order=True)])
+
+    async def load_messages_page(self, sender, receiver, after_order, before_order, limit):
+        key = conversation_id(sender, receiver)
+        messages = self.cache.get_page(key, after_order, before_order, limit)
+        if messages is not None:
+            return messages
+        if after_order is None and before_order is None:
+            # Load a full tail so later pages and cursors hit the cache too.
+            tail_size = max(limit, self.cache.tail_size)
+            tail = await self.run_storage(self.storage.get_messages_page, sender, receiver, None, None, tail_size)
+            # Skip caching if messages were numbered while the tail was loading.
+            # Storage pages are only short when they reach the first message.
+            if await self.writer.allocator.is_settled(key, tail):
+                self.cache.put_tail(key, tail, len(tail) < tail_size)
+            return tail[-limit:]
+        return await self.run_storage(self.storage.get_messages_page, sender, receiver, after_order, before_order, limit)
+
+    async def handle_unsubscribe(self, connection, parts):
+        connection.subscription = None
+
+    async def handle_video_call_request(self, connection, parts):
+        # An optional call id invites one more person into a running call.
+        sender, receiver = parts[1], parts[2]
+        call_id = parts[3] if len(parts) > 3 and parts[3] else None
+        if not self.is_online(receiver):
+            self.log(f"Receiver {receiver} not found in client_sockets")
+            return
+        if call_id is None:
+            call_id = await self.call_relay("create_call", sender)
+        elif not await self.call_relay("is_member", call_id, sender):
+            connection.reply(f"video_call_error|{call_id}|not in this call")
+            return
+        # Each participant joins the relay with a token only they are sent.
+        token = await self.call_relay("invite", call_id, receiver) or ""
+        self.send_to(receiver, ["video_call_request", sender, receiver, call_id, str(self.media_port), token])
+        self.log(f"Sending video call request from {sender} to {receiver}")
+
+    async def handle_video_call_response(self, connection, parts):
+        sender, receiver, response = parts[1], parts[2], parts[3]
+        call_id = parts[4] if len(parts) > 4 else ""
+        token = ""
+        if response != "accept" and call_id:
+            await self.call_relay("decline", call_id, sender)
+        elif call_id:
+            # The caller's own token, for joining the call it started.
+            token = await self.call_relay("join_token", call_id, receiver) or ""
+        if self.send_to(receiver, ["video_call_response", receiver, sender, response, call_id, str(self.media_port),
+                                   token]):
+            self.log(f"Sending video call response from {sender} to {receiver}: {response}")
+        else:
+            self.log(f"Receiver {receiver} not found in client_sockets")
+
+    async def handle_file_transfer(self, connection, parts):
+        sender, receiver, file_name, file_size = parts[1], parts[2], parts[3], int(parts[4])
+        try:
+            connection.reply("ready_to_receive")
+            await connection.drain()
+            file_data = await connection.read_data(file_size)
+            file_name = os.path.basename(file_name)
+            file_hash = await self.run_file_io(self.attachments.store_bytes, file_data)
+            self.log(f"File '{file_name}' received from {sender} and stored as {file_hash}")
+            await self.file_message_received(sender, receiver, file_name, file_hash)
+        except (asyncio.IncompleteReadError, ProtocolError):
+            raise
+        except Exception as e:
+            self.log(f"Error handling file transfer: {str(e)}")
+
+    async def handle_upload(self, connection, parts):
+        sender, receiver, file_name, file_size, upload_id = parts[1], parts[2], parts[3], int(parts[4]), parts[5]
+        file_name = os.path.basename(file_name)
+        file_hash = parts[6] if len(parts) > 6 else None
+        if not connection.framed:
+            connection.reply(f"upload_error|{upload_id}|Chunked uploads need the framed protocol")
+            return
+        # Content already sent in this conversation is not sent again: the new
+        # message just takes another reference to the stored attachment. Other
+        # content is uploaded even when the server holds it, so knowing a hash
+        # does not give access to a file; it is deduplicated when stored.
+        if (file_hash and await self.run_file_io(self.attachments.exists, file_hash)
+                and await self.conversation_has_file(sender, receiver, file_name, file_hash)):
+            if await self.run_file_io(self.attachments.add_reference, file_hash):
+                await self.file_message_received(sender, receiver, file_name, file_hash)
+                connection.reply(["upload_exists", upload_id, file_name])
+                return
+        removed = await self.run_file_io(self.uploads.expire)
+        if removed:
+            self.log(f"Deleted {removed} abandoned partial uploads")
+        try:
+            offset = await self.run_file_io(self.uploads.offset, upload_id)
+        except ValueError as e:
+            connection.reply(["upload_error", upload_id, str(e)])
+            return
+        if offset > file_size:
+            await self.run_file_io(self.uploads.discard, upload_id)
+            offset = 0
+        connection.reply(f"upload_offset|{upload_id}|{offset}")
+        await connection.drain()
+
+        # Chunks are written as they arrive, so memory use does not depend on
+        # the file size. A chunk at the wrong offset or with a bad checksum is
+        # dropped along with everything after it; the reply to upload_end then
+        # tells the client where to resume.
+        file = await self.run_file_io(self.uploads.open, upload_id)
+        try:
+            while True:
+                frame = await connection.read_frame()
+                if frame is None:
+                    return False
+                if frame.frame_type == FRAME_TEXT:
+                    if connection.parse(frame.text())[0] != "upload_end":
+                        raise ProtocolError(f"Unexpected command during upload: {frame.text()}")
+                    if offset >= file_size:
+                        break
+                    connection.reply(f"upload_offset|{upload_id}|{offset}")
+                    await connection.drain()
+                    continue
+                chunk_offset, data, valid = decode_chunk(frame.payload)
+                if chunk_offset != offset or not valid or offset + len(data) > file_size:
+                    continue
+                offset = await self.run_file_io(write_chunk, file, data)
+        finally:
+            await self.run_file_io(file.close)
+
+        partial_path = self.uploads.partial_path(upload_id)
+        received_hash = await self.run_file_io(hash_file, partial_path)
+        if file_hash and received_hash != file_hash:
+            await self.run_file_io(self.uploads.discard, upload_id)
+            connection.reply(f"upload_error|{upload_id}|Checksum of the uploaded file does not match")
+            return
+        await self.run_file_io(self.attachments.store_file, partial_path, received_hash)
+        self.log(f"File '{file_name}' received from {sender} and stored as {received_hash}")
+        await self.file_message_received(sender, receiver, file_name, received_hash)
+        connection.reply(["upload_done", upload_id, file_name])
+
+    async def file_message_received(self, sender, receiver, file_name, file_hash):
+        # The caller took a reference to the attachment for this message,
+        # which is given back if the message is never saved.
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            await self.save_message(sender, receiver, file_name, "file", timestamp, file_hash=file_hash)
+        except Exception:
+            await self.release_attachment(file_hash)
+            raise
+        self.send_to(receiver, ["file_received", sender, file_name])
+
+    async def release_attachment(self, file_hash):
+        try:
+            await self.run_file_io(self.attachments.release, file_hash)
+        except Exception as e:
+            self.log(f"Error releasing attachment {file_hash}: {str(e)}")
+
+    async def conversation_has_file(self, username, peer, file_name, file_hash):
+        # A stored file is only served to, or reused by, the users of a
+        # conversation with a message for it: by content hash, or by name for
+        # files sent before attachments were content-addressed.
+        try:
+            messages = await self.load_all_messages(username, peer)
+        except Exception as e:
+            self.log(f"Error loading messages of {username} and {peer}: {str(e)}")
+            return False
+        for msg in messages:
+            if msg['message_type'] != "file":
+                continue
+            if file_hash and msg.get('file_hash') == file_hash:
+                return True
+            if not file_hash and not msg.get('file_hash') and msg['message'] == file_name:
+                return True
+        return False
+
+    async def handle_download(self, connection, parts):
+        file_name = os.path.basename(parts[3])
+        offset = parse_order(parts, 4) or 0
+        length = parse_order(parts, 5)
+        file_hash = parts[6] if len(parts) > 6 else ""
+        if not connection.framed:
+            connection.reply(["download_error", file_name, "Downloads need the framed protocol"])
+            return
+        try:
+            if not await self.conversation_has_file(parts[1], parts[2], file_name, file_hash):
+                raise ValueError(f"No file {file_name} between {parts[1]} and {parts[2]}")
+            if file_hash:
+                file, file_size = await self.run_file_io(open_download, *os.path.split(self.attachments.path(file_hash)))
+            else:
+                # Files uploaded before attachments were content-addressed.
+                file, file_size = await self.run_file_io(open_download, SERVER_DATA_DIR, file_name)
+        except (OSError, ValueError):
+            connection.reply(["download_error", file_name, "File not found"])
+            return
+        try:
+            if offset > file_size:
+                connection.reply(["download_error", file_name, f"Offset {offset} is past the end of the file"])
+                return
+            count = file_size - offset if length is None else min(length, file_size - offset)
+            connection.reply(["download_begin", file_name, str(offset), str(count), str(file_size)])
+            # loop.sendfile uses os.sendfile where the transport allows it and
+            # otherwise falls back to reading into a reused buffer.
+            sent = 0
+            while sent < count:
+                frame_size = min(DOWNLOAD_FRAME_SIZE, count - sent)
+                connection.writer.write(HEADER.pack(frame_size, FRAME_BINARY, 0))
+                await self.loop.sendfile(connection.writer.transport, file, offset + sent, frame_size)
+                sent += frame_size
+            connection.reply(["download_end", file_name])
+        finally:
+            await self.run_file_io(file.close)
+
+def conversation_id(sender, receiver):
+    return '-'.join(sorted([sender, receiver]))
+
+def format_messages(messages, with_order=False):
+    return [format_message(msg, with_order) for msg in messages]
+
+def format_message(msg, with_order=False):
+    fields = [msg['sender'], msg['message'], msg['message_type'], msg['timestamp']]
+    if with_order:
+        fields.insert(0, str(msg['order']))
+    # Attachments carry their content hash after the legacy fields.
+    if msg.get('file_hash'):
+        fields.append(msg['file_hash'])
+    return fields
+
+def parse_order(parts, index):
+    if len(parts) > index and parts[index].isdigit():
+        return int(parts[index])
+    return None
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
+import time
+from Storage import get_storage
+from ChatServer import ChatServer
+from Broker import Broker, BrokerClient
+
+SERVICE_HOST = "::"
+SERVICE_PORT = 1234
+# Events waiting for a monitor; when nobody drains them the newest are dropped.
+EVENT_QUEUE_SIZE = 10000
+WORKER_CHECK_INTERVAL = 1.0
+# Seconds the monitor waits for the server to copy its user directory.
+USER_LIST_TIMEOUT = 2.0
+
+class ChatService:
+    # The chat server without any GUI. Log lines and user events go to stdout
+    # and, when events is a queue, to whoever drains it (the Qt monitor) as
+    # (kind, value) tuples: ("log", text), ("started", port), ("stopped", port),
+    # ("user_registered" / "user_online" / "user_offline", username).
+    def __init__(self, host=SERVICE_HOST, port=SERVICE_PORT, storage=None, events=None, echo=True, label=None,
+                 **server_options):
+        self.host = host
+        self.port = port
+        self.storage = storage if storage is not None else get_storage()
+        self.events = events
+        self.echo = echo
+        self.label = label
+        self.server_options = server_options
+        self.dropped_events = 0
+        self.chat_server = None
+
+    def post(self, kind, value):
+        if self.events is None:
+            return
+        try:
+            self.events.put_nowait((kind, value))
+        except queue.Full:
+            self.dropped_events += 1
+
+    def log(self, message):
+        if self.echo:
+            label = f"[{self.label}] " if self.label else ""
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {label}{message}", flush=True)
+        self.post("log", message)
+
+    @property
+    def running(self):
+        return self.chat_server is not None
+
+    def start(self):
+        if self.chat_server:
+            return
+        chat_server = ChatServer(self.host, self.port, storage=self.storage, log=self.log, on_event=self.post,
+                                 **self.server_options)
+        chat_server.start_in_thread()
+        self.chat_server = chat_server
+        self.post("started", self.port)
+
+    def stop(self):
+        if self.chat_server:
+            self.chat_server.stop()
+            self.chat_server = None
+            self.post("stopped", self.port)
+
+    def user_list(self):
+        # Called from the monitor's thread: the directory is copied on the
+        # server's event loop, which changes it.
+        chat_server = self.chat_server
+        if chat_server and chat_server.loop is not None:
+            try:
+                users = asyncio.run_coroutine_threadsafe(chat_server.user_list(), chat_server.loop).result(
+                    USER_LIST_TIMEOUT)
+            except (RuntimeError, concurrent.futures.TimeoutError) as e:
+                self.log(f"Could not read the user directory: {str(e) or 'timed out'}")
+                users = None
+            if users is not None:
+                return users
+        return self.storage.get_user_list()
+
+    def online_count(self):
+        return len(self.chat_server.client_sockets) if self.chat_server else 0
+
+    def run_until_signal(self):
+        stopping = threading.Event()
+        for name in ("SIGINT", "SIGTERM"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), lambda signum, frame: stopping.set())
+        self.start()
+        try:
+            # Short waits so Ctrl+C is handled on Windows as well.
+            while not stopping.wait(0.5):
+                pass
+        finally:
+            self.log("Shutting down")
+            self.stop()
+
+def run_worker(worker_id, host, port, backend, storage_options, broker_path, server_options):
+    # Entry point of a worker process started by WorkerPool.
+    service = ChatService(host, port, storage=get_storage(backend, **storage_options), label=f"worker {worker_id}",
+                          reuse_port=True, **server_options)
+    service.server_options["broker"] = BrokerClient(broker_path, worker_id, log=service.log)
+    service.run_until_signal()
+
+class WorkerPool:
+    # Runs the broker and the media relay in this process and the chat server
+    # in `workers` processes that share the listening port with SO_REUSEPORT.
+    # A worker that dies is started again.
+    def __init__(self, workers, host, port, backend=None, storage_options=None, broker_path=None, media_port=None,
+                 metrics_port=None, **server_options):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.backend = backend
+        self.storage_options = storage_options or {}
+        self.broker_path = broker_path or os.path.join(tempfile.gettempdir(), f"pychat-broker-{port}.sock")
+        self.media_port = media_port if media_port is not None else port + 1
+        # Each worker serves its own metrics, on consecutive ports.
+        self.metrics_port = metrics_port if metrics_port is not None else port + 2
+        self.server_options = server_options
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.broker = Broker(self.broker_path, host, self.media_port, log=self.log)
+
+    def log(self, message):
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} [broker] {message}", flush=True)
+
+    def start_worker(self, worker_id):
+        server_options = dict(self.server_options, media_port=self.media_port,
+                              metrics_port=self.metrics_port + worker_id)
+        process = self.context.Process(
+            target=run_worker, name=f"chat-worker-{worker_id}",
+            args=(worker_id, self.host, self.port, self.backend, self.storage_options, self.broker_path, server_options))
+        process.start()
+        self.processes[worker_id] = process
+
+    async def supervise(self):
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+        await self.broker.start()
+        for worker_id in range(self.workers):
+            self.start_worker(worker_id)
+        self.log(f"Started {self.workers} workers on port {self.port}")
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            for worker_id, process in list(self.processes.items()):
+                if not process.is_alive() and not stopping.is_set():
+                    self.log(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                    self.start_worker(worker_id)
+        self.log("Shutting down")
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            await loop.run_in_executor(None, process.join, 10)
+        self.broker.close()
+
+    def run_until_signal(self):
+        asyncio.run(self.supervise())
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server without a GUI.")
+    parser.add_argument("--host", default=SERVICE_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--storage", choices=("firestore", "sqlite"), help="storage backend (default: $PYCHAT_STORAGE)")
+    parser.add_argument("--sqlite-path", help="database file of the sqlite backend")
+    parser.add_argument("--media-port", type=int, help="media relay port (default: port + 1)")
+    parser.add_argument("--metrics-port", type=int, help="Prometheus metrics port (default: port + 2)")
+    parser.add_argument("--flush-interval", type=float, default=0.05, help="seconds between message batch writes")
+    parser.add_argument("--no-durable-ack", action="store_true", help="deliver messages before they are committed")
+    parser.add_argument("--workers", type=int, default=1, help="number of server processes")
+    parser.add_argument("--broker-path", help="UNIX socket the workers use to reach the broker")
+    parser.add_argument("--no-legacy-identify", action="store_true",
+                        help="ignore legacy clients that identify with a bare username instead of logging in")
+    args = parser.parse_args()
+
+    storage_options = {"path": args.sqlite_path} if args.sqlite_path else {}
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+            parser.error("--workers needs SO_REUSEPORT and UNIX sockets, which this platform does not have")
+        pool = WorkerPool(args.workers, args.host, args.port, args.storage, storage_options, args.broker_path,
+                          args.media_port, args.metrics_port, flush_interval=args.flush_interval,
+                          durable_ack=not args.no_durable_ack, legacy_identify=not args.no_legacy_identify)
+        pool.run_until_signal()
+        return
+    service = ChatService(args.host, args.port, storage=get_storage(args.storage, **storage_options),
+                          media_port=args.media_port, metrics_port=args.metrics_port,
+                          flush_interval=args.flush_interval, durable_ack=not args.no_durable_ack,
+                          legacy_identify=not args.no_legacy_identify)
+    service.run_until_signal()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+MESSAGE_OVERHEAD = 200
+
+class CacheEntry:
+    __slots__ = ("messages", "size", "has_start")
+
+    def __init__(self, messages, has_start):
+        self.messages = messages
+        self.size = sum(message_size(message) for message in messages)
+        # has_start means messages[0] is the first message of the conversation,
+        # so a page that runs past the cached range is still complete.
+        self.has_start = has_start
+
+class ConversationCache:
+    def __init__(self, max_conversations=1000, max_bytes=64 * 1024 * 1024, tail_size=200):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.tail_size = tail_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_page(self, conversation_id, after_order=None, before_order=None, limit=50):
+        entry = self.entries.get(conversation_id)
+        page = None
+        if entry is not None:
+            messages = entry.messages
+            if after_order is not None:
+                if entry.has_start or (messages and after_order >= messages[0]["order"] - 1):
+                    page = [message for message in messages if message["order"] > after_order][:limit]
+            else:
+                if before_order is not None:
+                    messages = [message for message in messages if message["order"] < before_order]
+                if len(messages) >= limit or entry.has_start:
+                    page = messages[-limit:]
+        if page is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(conversation_id)
+        return page
+
+    def get_all(self, conversation_id):
+        entry = self.entries.get(conversation_id)
+        if entry is None or not entry.has_start:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(conversation_id)
+        return list(entry.messages)
+
+    def put_tail(self, conversation_id, messages, has_start):
+        self.discard(conversation_id)
+        entry = CacheEntry(list(messages[-self.tail_size:]), has_start and len(messages) <= self.tail_size)
+        self.entries[conversation_id] = entry
+        self.size += entry.size
+        self.evict()
+
+    def append(self, conversation_id, message):
+        entry = self.entries.get(conversation_id)
+        if entry is None:
+            return
+        messages = entry.messages
+        last_order = messages[-1]["order"] if messages else 0
+        if message["order"] <= last_order:
+            return
+        if message["order"] != last_order + 1 or (not messages and not entry.has_start):
+            # A gap means the tail no longer matches storage; reload it later.
+            self.discard(conversation_id)
+            return
+        messages.append(message)
+        added = message_size(message)
+        entry.size += added
+        self.size += added
+        while len(messages) > self.tail_size:
+            removed = message_size(messages.pop(0))
+            entry.size -= removed
+            self.size -= removed
+            entry.has_start = False
+        self.evict()
+
+    def discard(self, conversation_id):
+        entry = self.entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_conversations or self.size > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "conversations": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+def message_size(message):
+    return MESSAGE_OVERHEAD + sum(len(value) for value in message.values() if isinstance(value, str))
@@ -0,0 +1,63 @@
+import os
+import re
+import time
+
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{16,64}$")
+# Partial uploads nobody has written to for this long are given up on and
+# deleted, at startup and then at most every EXPIRE_INTERVAL seconds.
+PARTIAL_UPLOAD_TTL = 2 * 24 * 3600
+EXPIRE_INTERVAL = 600
+
+class UploadStore:
+    def __init__(self, data_dir, ttl=PARTIAL_UPLOAD_TTL):
+        self.partial_dir = os.path.join(data_dir, ".uploads")
+        if not os.path.exists(self.partial_dir):
+            os.makedirs(self.partial_dir)
+        self.ttl = ttl
+        self.last_expire = 0
+        self.expire()
+
+    def partial_path(self, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            raise ValueError(f"Invalid upload id: {upload_id}")
+        return os.path.join(self.partial_dir, upload_id + ".part")
+
+    def offset(self, upload_id):
+        path = self.partial_path(upload_id)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def open(self, upload_id):
+        # Append mode, so a resumed upload continues where the last one stopped.
+        return open(self.partial_path(upload_id), 'ab')
+
+    def discard(self, upload_id):
+        path = self.partial_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def expire(self):
+        # Returns how many partial uploads were deleted.
+        now = time.time()
+        if now - self.last_expire < EXPIRE_INTERVAL:
+            return 0
+        self.last_expire = now
+        removed = 0
+        for entry in os.scandir(self.partial_dir):
+            if not entry.name.endswith(".part"):
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # Finished or expired by another worker meanwhile.
+                pass
+        return removed
+
+def write_chunk(file, data):
+    file.write(data)
+    return file.tell()
+
+def open_download(data_dir, file_name):
+    file = open(os.path.join(data_dir, os.path.basename(file_name)), 'rb')
+    return file, os.fstat(file.fileno()).st_size
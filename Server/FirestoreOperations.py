@@ -1,49 +1,126 @@
 from firebase_admin import credentials, firestore, initialize_app
 import uuid, logging
+from Storage import Storage
 
-cred = credentials.Certificate("Firestore/py-chat-ipv6.json")
-firebase_app = initialize_app(cred)
-db = firestore.client()
+CREDENTIALS_PATH = "Firestore/py-chat-ipv6.json"
+FIRESTORE_BATCH_LIMIT = 500
+# Messages live in Conversations/<id>/Buckets/<n>, BUCKET_SIZE per bucket,
+# with Conversations/<id> holding the latest order and bucket number.
+BUCKET_SIZE = 200
+firebase_app = None
+db = None
 
-class FirestoreOperations:
+def get_db():
+    global firebase_app, db
+    if db is None:
+        cred = credentials.Certificate(CREDENTIALS_PATH)
+        firebase_app = initialize_app(cred)
+        db = firestore.client()
+    return db
+
+def conversation_ref(conversation_id):
+    return get_db().collection("Conversations").document(conversation_id)
+
+def bucket_ref(conversation_id, bucket):
+    return conversation_ref(conversation_id).collection("Buckets").document(str(bucket))
+
+def bucket_of(order):
+    return (order - 1) // BUCKET_SIZE
+
+@firestore.transactional
+def append_message(transaction, conversation_id, message):
+    head_ref = conversation_ref(conversation_id)
+    head = head_ref.get(transaction=transaction)
+    order = ((head.to_dict() or {}).get("order", 0) if head.exists else 0) + 1
+    message = dict(message, order=order)
+    transaction.set(bucket_ref(conversation_id, bucket_of(order)), {str(order): message}, merge=True)
+    transaction.set(head_ref, {"order": order, "latest_bucket": bucket_of(order)}, merge=True)
+    return order
+
+def legacy_messages(legacy_doc):
+    # Messages of the old layout, every one a numbered field of Messages/<id>.
+    messages = []
+    for key, message in (legacy_doc.to_dict() or {}).items():
+        if isinstance(message, dict):
+            messages.append(dict(message, order=message.get("order") or int(key)))
+    return sorted(messages, key=lambda message: message["order"])
+
+def group_buckets(messages):
+    buckets = {}
+    for message in messages:
+        buckets.setdefault(bucket_of(message["order"]), {})[str(message["order"])] = message
+    return buckets
+
+@firestore.transactional
+def migrate_legacy(transaction, conversation_id):
+    # Moves Messages/<id> into buckets unless the conversation already has a
+    # head. Returns the last order, or None when a head was there.
+    head_ref = conversation_ref(conversation_id)
+    if head_ref.get(transaction=transaction).exists:
+        return None
+    legacy_doc = get_db().collection("Messages").document(conversation_id).get(transaction=transaction)
+    messages = legacy_messages(legacy_doc) if legacy_doc.exists else []
+    if not messages:
+        return 0
+    for bucket, values in group_buckets(messages).items():
+        transaction.set(bucket_ref(conversation_id, bucket), values, merge=True)
+    last_order = messages[-1]["order"]
+    transaction.set(head_ref, {"order": last_order, "latest_bucket": bucket_of(last_order), "legacy_migrated": True},
+                    merge=True)
+    return last_order
+
+class FirestoreOperations(Storage):
     @staticmethod
     def get_user_list():
         try:
-            user_docs = db.collection("Users").stream()
+            user_docs = get_db().collection("Users").stream()
             user_list = [user.id for user in user_docs] 
             return user_list
         except Exception as e:
             logging.error(f"Error getting user list from Firestore: {str(e)}")
             return []
     
+    @staticmethod
+    def get_users():
+        user_docs = get_db().collection("Users").select(["username", "name", "phone"]).stream()
+        return [dict(user.to_dict() or {}, username=user.id) for user in user_docs]
+
     @staticmethod
     def add_friend(username, friend_identifier):
-        user_ref = db.collection("Users").document(username)
         friend_query = None
         if friend_identifier.isdigit():
-            friend_query = db.collection("Users").where("phone", "==", friend_identifier)
+            friend_query = get_db().collection("Users").where("phone", "==", friend_identifier)
         elif friend_identifier.isalpha():
-            friend_query = db.collection("Users").where("name", "==", friend_identifier)
+            friend_query = get_db().collection("Users").where("name", "==", friend_identifier)
         else:
-            friend_query = db.collection("Users").where("username", "==", friend_identifier)
+            friend_query = get_db().collection("Users").where("username", "==", friend_identifier)
         friend_docs = friend_query.limit(1).get()
+        if not friend_docs and (friend_identifier.isdigit() or friend_identifier.isalpha()):
+            # Usernames chosen from search results can look like a phone or name.
+            friend_docs = get_db().collection("Users").where("username", "==", friend_identifier).limit(1).get()
         if friend_docs:
             friend_data = friend_docs[0].to_dict()
-            user_data = user_ref.get().to_dict()
-            friend_username = friend_data["username"]
-            if friend_username not in user_data["friends"]:
-                user_ref.update({"friends": firestore.ArrayUnion([friend_username])})
-                friend_ref = db.collection("Users").document(friend_username)
-                friend_ref.update({"friends": firestore.ArrayUnion([username])})
-                return "add_friend_success"
-            else:
-                return "Friend already added"
+            return FirestoreOperations.add_friendship(username, friend_data["username"])
         else:
             return "User or friend not found"
 
+    @staticmethod
+    def add_friendship(username, friend_username):
+        user_ref = get_db().collection("Users").document(username)
+        user_data = user_ref.get().to_dict()
+        if not user_data:
+            return "User or friend not found"
+        if friend_username not in user_data.get("friends", []):
+            user_ref.update({"friends": firestore.ArrayUnion([friend_username])})
+            friend_ref = get_db().collection("Users").document(friend_username)
+            friend_ref.update({"friends": firestore.ArrayUnion([username])})
+            return "add_friend_success"
+        else:
+            return "Friend already added"
+
     @staticmethod
     def get_friends_list(username):
-        user_ref = db.collection("Users").document(username)
+        user_ref = get_db().collection("Users").document(username)
         user_data = user_ref.get().to_dict()
         if user_data and "friends" in user_data:
             friends_list = user_data["friends"]
@@ -58,64 +135,101 @@ class FirestoreOperations:
     def save_message(sender, receiver, message, message_type, timestamp):
         try:
             conversation_id = '-'.join(sorted([sender, receiver]))
-            messages_ref = db.collection("Messages").document(conversation_id)
-            if messages_ref.get().exists:
-                current_order = messages_ref.get().to_dict().get("order", 1)
-                message_id = str(current_order + 1)
-
-                messages_ref.update({
-                    message_id: {
-                        "order": current_order + 1,
-                        "sender": sender,
-                        "receiver": receiver,
-                        "message": message,
-                        "message_type": message_type,
-                        "timestamp": timestamp
-                    },
-                    "order": current_order + 1
-                })
-            else:
-                message_id = "1"
-                messages_ref.set({
-                    message_id: {
-                        "order": 1,
-                        "sender": sender,
-                        "receiver": receiver,
-                        "message": message,
-                        "message_type": message_type,
-                        "timestamp": timestamp
-                    },
-                    "order": 1
-                })
-
+            transaction = get_db().transaction()
+            append_message(transaction, conversation_id, {
+                "sender": sender,
+                "receiver": receiver,
+                "message": message,
+                "message_type": message_type,
+                "timestamp": timestamp
+            })
             return "save_message_success"
         except Exception as e:
             print(f"Error saving message to Firestore: {str(e)}")
             return "save_message_failed"
 
+    @staticmethod
+    def save_messages(messages):
+        # One merged write per touched bucket plus one per conversation head,
+        # committed as WriteBatches.
+        writes = {}
+        heads = {}
+        for message in messages:
+            conversation_id = '-'.join(sorted([message["sender"], message["receiver"]]))
+            bucket = bucket_of(message["order"])
+            writes.setdefault((conversation_id, bucket), {})[str(message["order"])] = message
+            heads[conversation_id] = max(heads.get(conversation_id, 0), message["order"])
+        operations = [(bucket_ref(conversation_id, bucket), data) for (conversation_id, bucket), data in writes.items()]
+        operations += [(conversation_ref(conversation_id), {"order": order, "latest_bucket": bucket_of(order)})
+                       for conversation_id, order in heads.items()]
+        for start in range(0, len(operations), FIRESTORE_BATCH_LIMIT):
+            batch = get_db().batch()
+            for ref, data in operations[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.set(ref, data, merge=True)
+            batch.commit()
+
+    @staticmethod
+    def get_last_order(sender, receiver):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        head = conversation_ref(conversation_id).get()
+        if not head.exists:
+            # A conversation of the old layout moves over the first time it is
+            # used, before it can get new messages.
+            last_order = migrate_legacy(get_db().transaction(), conversation_id)
+            if last_order is not None:
+                return last_order
+            head = conversation_ref(conversation_id).get()
+        return (head.to_dict() or {}).get("order", 0)
+
     @staticmethod
     def get_messages(sender, receiver):
-        try:
-            conversation_id = '-'.join(sorted([sender, receiver]))
-            messages_ref = db.collection("Messages").document(conversation_id)
-            if messages_ref.get().exists:
-                messages_data = messages_ref.get().to_dict()
-                if messages_data:
-                    valid_messages = {k: v for k, v in messages_data.items() if isinstance(v, dict)}
-                    messages = [v for _, v in sorted(valid_messages.items(), key=lambda item: item[1].get('order', 1))]
-                    return messages
-        except Exception as e:
-            print(f"Error getting messages from Firestore: {str(e)}")
-        return []
+        # Errors are raised, not turned into an empty history the server could
+        # send or cache as the whole conversation.
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        FirestoreOperations.get_last_order(sender, receiver)
+        messages = []
+        for bucket_doc in conversation_ref(conversation_id).collection("Buckets").stream():
+            messages.extend(v for v in (bucket_doc.to_dict() or {}).values() if isinstance(v, dict))
+        return sorted(messages, key=lambda message: message.get('order', 1))
+
+    @staticmethod
+    def get_messages_page(sender, receiver, after_order=None, before_order=None, limit=50):
+        # Reads the small head document and then the buckets next to the
+        # cursor, a few at a time, until there are `limit` messages or the
+        # conversation ends; opening a chat touches the newest bucket. Orders
+        # have gaps (a failed batch skips its orders), so a short page always
+        # means the start or the end was reached, as with SqliteStorage.
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        last_order = FirestoreOperations.get_last_order(sender, receiver)
+        if after_order is not None:
+            low, high = after_order + 1, last_order
+        else:
+            low, high = 1, last_order if before_order is None else min(last_order, before_order - 1)
+        if low > high or limit <= 0:
+            return []
+        buckets = list(range(bucket_of(low), bucket_of(high) + 1))
+        if after_order is None:
+            buckets.reverse()
+        buckets_per_read = limit // BUCKET_SIZE + 2
+        messages = []
+        for start in range(0, len(buckets), buckets_per_read):
+            refs = [bucket_ref(conversation_id, bucket) for bucket in buckets[start:start + buckets_per_read]]
+            for bucket_doc in get_db().get_all(refs):
+                for value in (bucket_doc.to_dict() or {}).values():
+                    if isinstance(value, dict) and low <= value.get('order', 0) <= high:
+                        messages.append(value)
+            if len(messages) >= limit:
+                break
+        messages.sort(key=lambda message: message.get('order', 1))
+        return messages[:limit] if after_order is not None else messages[-limit:]
 
     @staticmethod
-    def register_user(name, username, password, phone, client_socket):
-        user_ref = db.collection("Users").document(username)
+    def register_user(name, username, password, phone):
+        user_ref = get_db().collection("Users").document(username)
         existing_user_data = user_ref.get().to_dict()
 
         if existing_user_data:
-            client_socket.send("Username already exists. Please choose another one.".encode('utf-8'))
-            return "register_failed"
+            return "Username already exists. Please choose another one."
         else:
             user_ref.set({
                 "name": name,
@@ -124,17 +238,14 @@ class FirestoreOperations:
                 "phone": phone,
                 "friends": []
             })
-            client_socket.send("register_success".encode('utf-8'))
             return "register_success"
 
     @staticmethod
-    def login_user(username, password, client_socket):
-        user_ref = db.collection("Users").document(username)
+    def login_user(username, password):
+        user_ref = get_db().collection("Users").document(username)
         user_data = user_ref.get().to_dict()
 
         if user_data and user_data["password"] == password:
-            client_socket.send("login_success".encode('utf-8'))
             return "login_success"
         else:
-            client_socket.send("Login failed. Please check your credentials.".encode('utf-8'))
             return "login_failed"
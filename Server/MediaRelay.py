@@ -0,0 +1,223 @@
+import asyncio
+import secrets
+import time
+from collections import deque
+from Protocol import MEDIA_CONTROL, MEDIA_HEADER, RELAY_HEADER, ProtocolError
+
+MAX_MEDIA_FRAME_SIZE = 16 * 1024 * 1024
+# Frames waiting for one viewer; past this the oldest is dropped so a slow
+# viewer loses frames instead of holding up the others.
+PEER_QUEUE_SIZE = 8
+KEYFRAME_REQUEST_INTERVAL = 0.5
+# Calls nobody has joined are forgotten after this many seconds.
+INVITE_TIMEOUT = 120
+
+class Room:
+    def __init__(self, call_id):
+        self.call_id = call_id
+        # Invited username -> the token they have to join with.
+        self.invited = {}
+        self.peers = {}
+        self.next_stream_id = 1
+        self.created = time.monotonic()
+
+class RelayPeer:
+    def __init__(self, room, username, stream_id, writer, queue_size):
+        self.room = room
+        self.username = username
+        self.stream_id = stream_id
+        self.writer = writer
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.last_keyframe_request = 0
+        self.closed = False
+
+    def enqueue(self, header, payload, source=None):
+        # source is the peer whose frame this is, or None for control frames,
+        # which are never dropped.
+        if source is not None:
+            queued_frames = sum(1 for item in self.queue if item[2] is not None)
+            if queued_frames >= self.queue_size:
+                for index, item in enumerate(self.queue):
+                    if item[2] is not None:
+                        del self.queue[index]
+                        self.dropped += 1
+                        # Later frames may depend on the dropped one.
+                        item[2].request_keyframe()
+                        break
+        self.queue.append((header, payload, source))
+        self.ready.set()
+
+    def send_control(self, text):
+        payload = text.encode('utf-8')
+        self.enqueue(RELAY_HEADER.pack(len(payload), MEDIA_CONTROL, 0), payload)
+
+    def request_keyframe(self):
+        now = time.monotonic()
+        if now - self.last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+            self.last_keyframe_request = now
+            self.send_control("keyframe")
+
+    async def send_loop(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and not self.closed:
+                    header, payload, _ = self.queue.popleft()
+                    self.writer.write(header)
+                    self.writer.write(payload)
+                    await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()
+        if not self.writer.is_closing():
+            self.writer.close()
+
+class MediaRelay:
+    # Forwards each participant's encoded video to every other participant of
+    # the same call without decoding it. Calls are created and people invited
+    # by the chat server's call_video_request/call_video_response handlers,
+    # which hand each participant the join token the relay issued for them.
+    def __init__(self, queue_size=PEER_QUEUE_SIZE, log=print):
+        self.queue_size = queue_size
+        self.log = log
+        self.rooms = {}
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_peer, host, port)
+        self.log(f"Media relay started on port: {port}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for room in list(self.rooms.values()):
+            for peer in list(room.peers.values()):
+                peer.close()
+        self.rooms.clear()
+
+    def create_call(self, username):
+        self.forget_stale_calls()
+        call_id = secrets.token_hex(8)
+        room = Room(call_id)
+        room.invited[username] = secrets.token_hex(16)
+        self.rooms[call_id] = room
+        return call_id
+
+    def invite(self, call_id, username):
+        # Returns the user's join token, or None if there is no such call.
+        room = self.rooms.get(call_id)
+        if room is None:
+            return None
+        return room.invited.setdefault(username, secrets.token_hex(16))
+
+    def join_token(self, call_id, username):
+        room = self.rooms.get(call_id)
+        return room.invited.get(username) if room is not None else None
+
+    def decline(self, call_id, username):
+        room = self.rooms.get(call_id)
+        if room is not None and username not in room.peers:
+            room.invited.pop(username, None)
+
+    def is_member(self, call_id, username):
+        room = self.rooms.get(call_id)
+        return room is not None and username in room.invited
+
+    def forget_stale_calls(self):
+        now = time.monotonic()
+        for call_id, room in list(self.rooms.items()):
+            if not room.peers and now - room.created > INVITE_TIMEOUT:
+                del self.rooms[call_id]
+
+    async def read_frame(self, reader):
+        size, codec_id = MEDIA_HEADER.unpack(await reader.readexactly(MEDIA_HEADER.size))
+        if size > MAX_MEDIA_FRAME_SIZE:
+            raise ProtocolError(f"Media frame of {size} bytes is too large")
+        return codec_id, await reader.readexactly(size)
+
+    async def handle_peer(self, reader, writer):
+        peer = None
+        send_task = None
+        try:
+            codec_id, payload = await self.read_frame(reader)
+            parts = payload.decode('utf-8', errors='replace').split("|")
+            if codec_id != MEDIA_CONTROL or parts[0] != "join" or len(parts) < 4:
+                return
+            peer = self.join(parts[1], parts[2], parts[3], writer)
+            if peer is None:
+                error = b"error|not invited to this call"
+                writer.write(RELAY_HEADER.pack(len(error), MEDIA_CONTROL, 0) + error)
+                await writer.drain()
+                return
+            send_task = asyncio.create_task(peer.send_loop())
+            room = peer.room
+            while True:
+                codec_id, payload = await self.read_frame(reader)
+                if codec_id == MEDIA_CONTROL:
+                    if payload == b"leave":
+                        break
+                    continue
+                header = RELAY_HEADER.pack(len(payload), codec_id, peer.stream_id)
+                for other in room.peers.values():
+                    if other is not peer:
+                        other.enqueue(header, payload, peer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except ProtocolError as e:
+            self.log(f"Media relay protocol error: {str(e)}")
+        except Exception as e:
+            self.log(f"Error relaying media: {str(e)}")
+        finally:
+            if peer is not None:
+                self.leave(peer)
+            if send_task is not None:
+                send_task.cancel()
+            if not writer.is_closing():
+                writer.close()
+
+    def join(self, call_id, username, token, writer):
+        room = self.rooms.get(call_id)
+        if room is None or username not in room.invited:
+            return None
+        if not secrets.compare_digest(room.invited[username], token):
+            return None
+        if username in room.peers:
+            # A reconnect replaces the previous connection of the same user.
+            self.leave(room.peers[username])
+        peer = RelayPeer(room, username, room.next_stream_id, writer, self.queue_size)
+        room.next_stream_id += 1
+        for other in room.peers.values():
+            peer.send_control(f"joined|{other.stream_id}|{other.username}")
+            other.send_control(f"joined|{peer.stream_id}|{username}")
+            # The newcomer needs a frame it can decode from everyone.
+            other.request_keyframe()
+        room.peers[username] = peer
+        self.log(f"{username} joined call {call_id} ({len(room.peers)} in call)")
+        return peer
+
+    def leave(self, peer):
+        room = peer.room
+        if room.peers.get(peer.username) is not peer:
+            return
+        del room.peers[peer.username]
+        peer.close()
+        for other in room.peers.values():
+            other.send_control(f"left|{peer.stream_id}|{peer.username}")
+        self.log(f"{peer.username} left call {room.call_id}")
+        if not room.peers:
+            self.rooms.pop(room.call_id, None)
+
+    def stats(self):
+        return {
+            "calls": len(self.rooms),
+            "participants": sum(len(room.peers) for room in self.rooms.values()),
+            "dropped_frames": sum(peer.dropped for room in self.rooms.values() for peer in room.peers.values())
+        }
@@ -0,0 +1,102 @@
+import asyncio
+
+class SequenceAllocator:
+    def __init__(self, storage, run_storage):
+        self.storage = storage
+        self.run_storage = run_storage
+        self.last_orders = {}
+        self.loading = {}
+
+    async def allocate(self, conversation_id, sender, receiver):
+        if conversation_id not in self.last_orders:
+            # The first message of a conversation since startup loads the
+            # counter from storage. Concurrent senders wait on the same load
+            # instead of issuing their own.
+            loading = self.loading.get(conversation_id)
+            if loading is None:
+                loading = asyncio.ensure_future(self.run_storage(self.storage.get_last_order, sender, receiver))
+                self.loading[conversation_id] = loading
+            try:
+                last_order = await loading
+            finally:
+                self.loading.pop(conversation_id, None)
+            self.last_orders.setdefault(conversation_id, last_order)
+        self.last_orders[conversation_id] += 1
+        return self.last_orders[conversation_id]
+
+    async def is_settled(self, conversation_id, messages):
+        # True when nothing after the last of messages has been numbered, so
+        # they are the whole tail of the conversation.
+        last_order = messages[-1]["order"] if messages else 0
+        return self.last_orders.get(conversation_id, last_order) == last_order
+
+class MessageWriter:
+    def __init__(self, storage, run_storage, flush_interval=0.05, max_batch=200, allocator=None, log=print):
+        self.storage = storage
+        self.run_storage = run_storage
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.log = log
+        self.allocator = allocator if allocator is not None else SequenceAllocator(storage, run_storage)
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def submit(self, sender, receiver, message, message_type, timestamp, file_hash=None):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        order = await self.allocator.allocate(conversation_id, sender, receiver)
+        record = {
+            "order": order,
+            "sender": sender,
+            "receiver": receiver,
+            "message": message,
+            "message_type": message_type,
+            "timestamp": timestamp
+        }
+        if file_hash:
+            record["file_hash"] = file_hash
+        saved = asyncio.get_running_loop().create_future()
+        self.pending.append((conversation_id, record, saved))
+        if len(self.pending) >= self.max_batch:
+            self.wakeup.set()
+        return record, saved
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                await self.run_storage(self.storage.save_messages, [record for _, record, _ in batch])
+            except Exception as e:
+                self.log(f"Error saving message batch: {str(e)}")
+                # The counters are kept: later orders of these conversations
+                # may already be queued, so reusing these would collide. The
+                # failed orders are left as gaps.
+                for _, _, saved in batch:
+                    if not saved.done():
+                        saved.set_exception(e)
+                continue
+            for _, record, saved in batch:
+                if not saved.done():
+                    saved.set_result(record)
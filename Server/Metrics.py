@@ -0,0 +1,219 @@
+import asyncio
+import bisect
+import threading
+import time
+
+METRICS_PREFIX = "pychat"
+# Upper bounds in seconds; one more bucket counts everything slower.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PERCENTILES = (50, 95, 99)
+
+def label_text(label, value):
+    value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return f'{label}="{value}"'
+
+class CounterFamily:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def increment(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+        for label_value, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{{{label_text(self.label, label_value)}}} {value}")
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+class HistogramFamily:
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(label_value)
+            if histogram is None:
+                histogram = self.histograms[label_value] = Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def copy(self):
+        with self.lock:
+            return {label_value: (list(histogram.counts), histogram.sum, histogram.count)
+                    for label_value, histogram in self.histograms.items()}
+
+    def percentile(self, counts, count, percent):
+        # Upper bound of the bucket holding the percentile, or None when it
+        # is in the overflow bucket.
+        rank = count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+    def snapshot(self):
+        result = {}
+        for label_value, (counts, total, count) in sorted(self.copy().items()):
+            entry = {"count": count, "total_seconds": round(total, 6), "mean_ms": round(total / count * 1000, 3)}
+            for percent in PERCENTILES:
+                bound = self.percentile(counts, count, percent)
+                entry[f"p{percent}_ms"] = round(bound * 1000, 3) if bound is not None else None
+            result[label_value] = entry
+        return result
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for label_value, (counts, total, count) in sorted(self.copy().items()):
+            label = label_text(self.label, label_value)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+
+class GaugeFamily:
+    # Read when metrics are collected. read() returns a number, or a dict of
+    # label value to number when the gauge has a label.
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def snapshot(self):
+        return self.read()
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} gauge")
+        value = self.read()
+        if self.label is None:
+            lines.append(f"{self.name} {value}")
+            return
+        for label_value, number in sorted(value.items()):
+            lines.append(f"{self.name}{{{label_text(self.label, label_value)}}} {number}")
+
+class Metrics:
+    # Counters and histograms are updated from the event loop and from the
+    # storage threads, so each family guards its values with its own lock.
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.families = {}
+        self.started = time.time()
+
+    def add(self, name, family):
+        self.families[name] = family
+        return family
+
+    def counter(self, name, help, label):
+        return self.add(name, CounterFamily(f"{self.prefix}_{name}", help, label))
+
+    def histogram(self, name, help, label, buckets=LATENCY_BUCKETS):
+        return self.add(name, HistogramFamily(f"{self.prefix}_{name}", help, label, buckets))
+
+    def gauge(self, name, help, read, label=None):
+        return self.add(name, GaugeFamily(f"{self.prefix}_{name}", help, read, label))
+
+    def snapshot(self):
+        result = {"uptime_seconds": round(time.time() - self.started, 1)}
+        for name, family in self.families.items():
+            result[name] = family.snapshot()
+        return result
+
+    def render(self):
+        lines = []
+        for family in self.families.values():
+            family.render(lines)
+        return "\n".join(lines) + "\n"
+
+class InstrumentedStorage:
+    # Wraps a storage backend so every call is timed per method. Calls run on
+    # the storage threads, so the time does not include waiting for a worker.
+    def __init__(self, storage, calls, errors):
+        self.storage = storage
+        self.calls = calls
+        self.errors = errors
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if not callable(attribute):
+            return attribute
+        calls, errors = self.calls, self.errors
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                errors.increment(name)
+                raise
+            finally:
+                calls.observe(name, time.perf_counter() - start)
+
+        # Later lookups find the wrapper without going through __getattr__.
+        setattr(self, name, call)
+        return call
+
+class MetricsServer:
+    # Serves Metrics.render() as Prometheus text over plain HTTP.
+    def __init__(self, metrics, log=print):
+        self.metrics = metrics
+        self.log = log
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_request, host, port)
+        self.log(f"Metrics available on http://{host}:{port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle_request(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), 5)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.metrics.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,92 @@
+import argparse
+from FirestoreOperations import (FIRESTORE_BATCH_LIMIT, bucket_of, bucket_ref, conversation_ref, get_db,
+                                 group_buckets, legacy_messages, migrate_legacy)
+
+# Moves the old layout (every message of a conversation as a numbered field of
+# Messages/<id>) to Conversations/<id>/Buckets/<n>. The server also does this
+# for a conversation the first time it is used; this tool moves the rest and,
+# with --merge, repairs conversations that got bucketed messages first.
+
+class AlreadyMigrated(Exception):
+    pass
+
+def migrate_conversation(conversation_doc, delete_old=False, merge=False):
+    conversation_id = conversation_doc.id
+    messages = legacy_messages(conversation_doc)
+    if not messages:
+        return 0
+    head = conversation_ref(conversation_id).get()
+    if not head.exists:
+        if migrate_legacy(get_db().transaction(), conversation_id) is not None:
+            if delete_old:
+                conversation_doc.reference.delete()
+            return len(messages)
+        # The server moved it in the meantime.
+        head = conversation_ref(conversation_id).get()
+    if (head.to_dict() or {}).get("legacy_migrated") or holds_messages(conversation_id, messages):
+        raise AlreadyMigrated(f"Conversation {conversation_id} is already migrated, skipped")
+    if not merge:
+        raise AlreadyMigrated(f"Conversation {conversation_id} got new messages before it was migrated, skipped; "
+                              f"run with --merge while the server is stopped to put the old ones before them")
+    merge_messages(conversation_id, messages)
+    if delete_old:
+        conversation_doc.reference.delete()
+    return len(messages)
+
+def holds_messages(conversation_id, messages):
+    # Conversations this tool migrated before heads were marked: the last old
+    # message is in its bucket.
+    last = messages[-1]
+    stored = (bucket_ref(conversation_id, bucket_of(last["order"])).get().to_dict() or {}).get(str(last["order"]))
+    return isinstance(stored, dict) and all(stored.get(field) == last.get(field)
+                                            for field in ("sender", "message", "timestamp"))
+
+def merge_messages(conversation_id, messages):
+    # The old messages keep their orders and the bucketed ones move up after
+    # them. Clients that cached the bucketed ones load them again.
+    offset = messages[-1]["order"]
+    current = []
+    for bucket_doc in conversation_ref(conversation_id).collection("Buckets").stream():
+        current.extend(v for v in (bucket_doc.to_dict() or {}).values() if isinstance(v, dict))
+    current.sort(key=lambda message: message["order"])
+    merged = messages + [dict(message, order=message["order"] + offset) for message in current]
+    last_order = merged[-1]["order"]
+    operations = [(bucket_ref(conversation_id, bucket), values) for bucket, values in group_buckets(merged).items()]
+    for start in range(0, len(operations), FIRESTORE_BATCH_LIMIT):
+        batch = get_db().batch()
+        for ref, values in operations[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(ref, values)
+        batch.commit()
+    conversation_ref(conversation_id).set(
+        {"order": last_order, "latest_bucket": bucket_of(last_order), "legacy_migrated": True}, merge=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Move Messages/<id> documents into bucketed conversations.")
+    parser.add_argument("--delete", action="store_true", help="delete each old document after it is migrated")
+    parser.add_argument("--conversation", action="append", help="only migrate the given conversation id")
+    parser.add_argument("--merge", action="store_true",
+                        help="renumber conversations that got new messages before migration (server must be stopped)")
+    args = parser.parse_args()
+
+    messages_ref = get_db().collection("Messages")
+    if args.conversation:
+        conversation_docs = [messages_ref.document(conversation_id).get() for conversation_id in args.conversation]
+    else:
+        conversation_docs = messages_ref.stream()
+
+    total = 0
+    for conversation_doc in conversation_docs:
+        if not conversation_doc.exists:
+            print(f"Conversation {conversation_doc.id} not found")
+            continue
+        try:
+            migrated = migrate_conversation(conversation_doc, args.delete, args.merge)
+        except AlreadyMigrated as e:
+            print(str(e))
+            continue
+        total += migrated
+        print(f"Migrated {migrated} messages of {conversation_doc.id}")
+    print(f"Done: {total} messages migrated")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import secrets
+import time
+
+# Sessions are kept alive for this long after their last use.
+SESSION_TTL = 7 * 24 * 3600
+EXPIRE_INTERVAL = 600
+
+class Session:
+    __slots__ = ("username", "expires")
+
+    def __init__(self, username, expires):
+        self.username = username
+        self.expires = expires
+
+class SessionManager:
+    # Maps the tokens handed out at login to usernames, so a client can
+    # reconnect with resume|<token> instead of logging in again. Only used
+    # from the server's event loop.
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.last_expire = time.time()
+
+    def create(self, username):
+        self.expire()
+        token = secrets.token_urlsafe(32)
+        self.sessions[token] = Session(username, time.time() + self.ttl)
+        return token
+
+    def resolve(self, token):
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        now = time.time()
+        if session.expires < now:
+            del self.sessions[token]
+            return None
+        session.expires = now + self.ttl
+        return session.username
+
+    def revoke(self, token):
+        self.sessions.pop(token, None)
+
+    def expire(self):
+        now = time.time()
+        if now - self.last_expire < EXPIRE_INTERVAL:
+            return
+        self.last_expire = now
+        for token, session in list(self.sessions.items()):
+            if session.expires < now:
+                del self.sessions[token]
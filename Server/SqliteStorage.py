@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import threading
+from Storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    password TEXT NOT NULL,
+    phone TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_phone ON users (phone);
+CREATE INDEX IF NOT EXISTS users_name ON users (name);
+CREATE TABLE IF NOT EXISTS friends (
+    username TEXT NOT NULL,
+    friend TEXT NOT NULL,
+    added INTEGER NOT NULL,
+    PRIMARY KEY (username, friend)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    msg_order INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    message TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    file_hash TEXT,
+    PRIMARY KEY (conversation_id, msg_order)
+) WITHOUT ROWID;
+"""
+
+MESSAGE_COLUMNS = "msg_order, sender, receiver, message, message_type, timestamp, file_hash"
+
+class SqliteStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection().executescript(SCHEMA)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        columns = [row[1] for row in self.connection().execute("PRAGMA table_info(messages)")]
+        if "file_hash" not in columns:
+            self.connection().execute("ALTER TABLE messages ADD COLUMN file_hash TEXT")
+
+    def connection(self):
+        # sqlite3 connections cannot be shared across threads, so each storage
+        # worker thread keeps its own.
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get_user_list(self):
+        try:
+            rows = self.connection().execute("SELECT username FROM users ORDER BY username").fetchall()
+            return [row[0] for row in rows]
+        except sqlite3.Error as e:
+            print(f"Error getting user list from SQLite: {str(e)}")
+            return []
+
+    def get_users(self):
+        rows = self.connection().execute("SELECT username, name, phone FROM users").fetchall()
+        return [{"username": row[0], "name": row[1], "phone": row[2]} for row in rows]
+
+    def add_friend(self, username, friend_identifier):
+        if friend_identifier.isdigit():
+            column = "phone"
+        elif friend_identifier.isalpha():
+            column = "name"
+        else:
+            column = "username"
+        connection = self.connection()
+        row = connection.execute(f"SELECT username FROM users WHERE {column} = ? LIMIT 1", (friend_identifier,)).fetchone()
+        if row is None and column != "username":
+            # Usernames chosen from search results can look like a phone or name.
+            row = connection.execute("SELECT username FROM users WHERE username = ?", (friend_identifier,)).fetchone()
+        if row is None or connection.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is None:
+            return "User or friend not found"
+        return self.add_friendship(username, row[0])
+
+    def add_friendship(self, username, friend_username):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            added = connection.execute(
+                "INSERT OR IGNORE INTO friends (username, friend, added) VALUES (?, ?, strftime('%s', 'now'))",
+                (username, friend_username)).rowcount
+            connection.execute(
+                "INSERT OR IGNORE INTO friends (username, friend, added) VALUES (?, ?, strftime('%s', 'now'))",
+                (friend_username, username))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        if added:
+            return "add_friend_success"
+        return "Friend already added"
+
+    def get_friends_list(self, username):
+        rows = self.connection().execute(
+            "SELECT friend FROM friends WHERE username = ? ORDER BY added, friend", (username,)).fetchall()
+        if rows:
+            return ";".join(row[0] for row in rows)
+        return "No friends found."
+
+    def save_message(self, sender, receiver, message, message_type, timestamp):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        connection = self.connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    f"INSERT INTO messages (conversation_id, {MESSAGE_COLUMNS}) "
+                    "SELECT ?, COALESCE(MAX(msg_order), 0) + 1, ?, ?, ?, ?, ?, NULL FROM messages WHERE conversation_id = ?",
+                    (conversation_id, sender, receiver, message, message_type, timestamp, conversation_id))
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+            return "save_message_success"
+        except sqlite3.Error as e:
+            print(f"Error saving message to SQLite: {str(e)}")
+            return "save_message_failed"
+
+    def save_messages(self, messages):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                f"INSERT INTO messages (conversation_id, {MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [('-'.join(sorted([m["sender"], m["receiver"]])), m["order"], m["sender"], m["receiver"],
+                  m["message"], m["message_type"], m["timestamp"], m.get("file_hash")) for m in messages])
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_last_order(self, sender, receiver):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        row = self.connection().execute(
+            "SELECT MAX(msg_order) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()
+        return row[0] or 0
+
+    def get_messages(self, sender, receiver):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        rows = self.connection().execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE conversation_id = ? ORDER BY msg_order",
+            (conversation_id,)).fetchall()
+        return [message_from_row(row) for row in rows]
+
+    def get_messages_page(self, sender, receiver, after_order=None, before_order=None, limit=50):
+        conversation_id = '-'.join(sorted([sender, receiver]))
+        connection = self.connection()
+        if after_order is not None:
+            rows = connection.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE conversation_id = ? AND msg_order > ? "
+                "ORDER BY msg_order LIMIT ?", (conversation_id, after_order, limit)).fetchall()
+        else:
+            rows = connection.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE conversation_id = ? AND msg_order < ? "
+                "ORDER BY msg_order DESC LIMIT ?",
+                (conversation_id, before_order if before_order is not None else 2 ** 62, limit)).fetchall()
+            rows.reverse()
+        return [message_from_row(row) for row in rows]
+
+    def register_user(self, name, username, password, phone):
+        try:
+            self.connection().execute(
+                "INSERT INTO users (username, name, password, phone) VALUES (?, ?, ?, ?)",
+                (username, name, password, phone))
+        except sqlite3.IntegrityError:
+            return "Username already exists. Please choose another one."
+        return "register_success"
+
+    def login_user(self, username, password):
+        row = self.connection().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        if row and row[0] == password:
+            return "login_success"
+        return "login_failed"
+
+def message_from_row(row):
+    message = {
+        "order": row[0],
+        "sender": row[1],
+        "receiver": row[2],
+        "message": row[3],
+        "message_type": row[4],
+        "timestamp": row[5]
+    }
+    if row[6]:
+        message["file_hash"] = row[6]
+    return message
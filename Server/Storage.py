@@ -0,0 +1,72 @@
+import os
+
+STORAGE_BACKEND = os.environ.get("PYCHAT_STORAGE", "firestore")
+# Databases live outside ServerData, whose files can be downloaded by name.
+SERVER_STATE_DIR = "ServerState"
+SQLITE_PATH = os.environ.get("PYCHAT_SQLITE_PATH", os.path.join(SERVER_STATE_DIR, "pychat.db"))
+LEGACY_SQLITE_PATH = os.path.join("ServerData", "pychat.db")
+
+class Storage:
+    def get_user_list(self):
+        raise NotImplementedError
+
+    def get_users(self):
+        # Directory records (username, name, phone) of every user.
+        raise NotImplementedError
+
+    def add_friend(self, username, friend_identifier):
+        raise NotImplementedError
+
+    def add_friendship(self, username, friend_username):
+        raise NotImplementedError
+
+    def get_friends_list(self, username):
+        raise NotImplementedError
+
+    def save_message(self, sender, receiver, message, message_type, timestamp):
+        raise NotImplementedError
+
+    def save_messages(self, messages):
+        # Commits a batch of message dicts that already carry their order.
+        raise NotImplementedError
+
+    def get_last_order(self, sender, receiver):
+        raise NotImplementedError
+
+    def get_messages(self, sender, receiver):
+        raise NotImplementedError
+
+    def get_messages_page(self, sender, receiver, after_order=None, before_order=None, limit=50):
+        raise NotImplementedError
+
+    def register_user(self, name, username, password, phone):
+        raise NotImplementedError
+
+    def login_user(self, username, password):
+        raise NotImplementedError
+
+def move_database(old_path, new_path):
+    # Moves a SQLite database, with its WAL files, from where older versions
+    # kept it unless there is already one at the new path.
+    if not os.path.exists(old_path) or os.path.exists(new_path):
+        return
+    directory = os.path.dirname(new_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(old_path + suffix):
+            os.replace(old_path + suffix, new_path + suffix)
+
+def get_storage(backend=None, **options):
+    backend = backend or STORAGE_BACKEND
+    # Backends are imported on demand so the server can run without the
+    # dependencies of the ones it does not use (e.g. firebase_admin).
+    if backend == "firestore":
+        from FirestoreOperations import FirestoreOperations
+        return FirestoreOperations
+    if backend == "sqlite":
+        from SqliteStorage import SqliteStorage
+        if "path" not in options and SQLITE_PATH != LEGACY_SQLITE_PATH:
+            move_database(LEGACY_SQLITE_PATH, SQLITE_PATH)
+        return SqliteStorage(options.get("path", SQLITE_PATH))
+    raise ValueError(f"Unknown storage backend: {backend}")
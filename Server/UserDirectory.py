@@ -0,0 +1,72 @@
+import bisect
+
+class UserDirectory:
+    def __init__(self):
+        self.users = {}
+        self.by_phone = {}
+        self.by_name = {}
+        # Sorted (lowercase key, username) pairs over usernames, names and
+        # phones, for prefix search from the find box.
+        self.search_keys = []
+        self.loaded = False
+
+    def load(self, users):
+        self.users.clear()
+        self.by_phone.clear()
+        self.by_name.clear()
+        self.search_keys = []
+        for user in users:
+            self.search_keys.extend(self.index(user))
+        self.search_keys.sort()
+        self.loaded = True
+
+    def add(self, user):
+        if user["username"] in self.users:
+            return
+        for key in self.index(user):
+            bisect.insort(self.search_keys, key)
+
+    def index(self, user):
+        username = user["username"]
+        self.users[username] = user
+        keys = [(username.lower(), username)]
+        if user.get("phone"):
+            self.by_phone.setdefault(user["phone"], username)
+            keys.append((user["phone"], username))
+        if user.get("name"):
+            self.by_name.setdefault(user["name"], username)
+            keys.append((user["name"].lower(), username))
+        return keys
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def resolve(self, identifier):
+        # Same rules as FirestoreOperations.add_friend: digits are a phone
+        # number, letters only a display name, anything else a username.
+        # Usernames picked from search results can be all letters or digits
+        # too, so those fall back to the username.
+        username = None
+        if identifier.isdigit():
+            username = self.by_phone.get(identifier)
+        elif identifier.isalpha():
+            username = self.by_name.get(identifier)
+        if username is None and identifier in self.users:
+            username = identifier
+        return username
+
+    def search(self, prefix, limit=20):
+        prefix = prefix.lower()
+        results = []
+        index = bisect.bisect_left(self.search_keys, (prefix, ""))
+        while index < len(self.search_keys) and len(results) < limit:
+            key, username = self.search_keys[index]
+            if not key.startswith(prefix):
+                break
+            if username not in results:
+                results.append(username)
+            index += 1
+        return results
+
+    def usernames(self):
+        return sorted(self.users)